@@ -1,63 +1,105 @@
 # This script is triggered by an SNS notification which contains a filename and a text
 # Script triggers AWS Polly to synthesize the text to speech and store the resulting MP3 with the filename from SNS Message on S3
+# The audio stream from Polly is uploaded to S3 as it is read, no temporary file is written
+# Audio is stored content addressed (mp3/greeting-<hash of text, voice and format>.mp3), Polly is only called if this
+# object does not exist yet. A File_name other than the content addressed name (e.g. No_face_match.mp3 from the
+# stack bootstrap) gets a copy of the shared object.
+# All records of an SNS event are processed concurrently (lambda_records.py)
+# A message contains one greeting (File_name, Text) or a list of them in Greetings (LambdaIndexFaces)
+
+from __future__ import print_function
 
 import boto3
+import botocore
+import hashlib
 import os
 from contextlib import closing
 import json
-import ast
+from lambda_records import process_records, summarize
+
+# Initialize variables from env. variables
+bucket = os.environ['BUCKET_NAME']
+
+# Initialize client connections, they are reused by warm containers
+polly = boto3.client('polly')
+s3 = boto3.client('s3')
+
+# Voice and format if the SNS message does not specify them
+defaultVoice = 'Joey'
+defaultFormat = 'mp3'
+
+# File name of the audio for text, voice and format (same scheme as in LambdaIndexFaces)
+def greeting_file_name(text, voice, outputFormat):
+    digest = hashlib.sha256(json.dumps([text, voice, outputFormat]).encode('utf-8')).hexdigest()
+    return 'greeting-' + digest[:32] + '.' + outputFormat
+
+def exists(key):
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] in ("404", "NoSuchKey"):
+            return False
+        raise
 
 def lambda_handler(event, context):
     
-    bucket = os.environ['BUCKET_NAME']
-    
     # Get Message content from SNS
-    message = event['Records'][0]['Sns']['Message']
-    print("SNS Message received:" + message)
+    greetings = []
+    for record in event['Records']:
+        message = record['Sns']['Message']
+        print("SNS Message received:" + message)
+        
+        # convert string to dict for direct access to elements and modification
+        # (JSON parsing keeps non-ASCII names intact, so the hash matches the one of LambdaIndexFaces)
+        message = json.loads(message)
+        greetings.extend(message.get("Greetings") or [message])
+    
+    return summarize(process_records(greetings, synthesize_greeting))
 
-    # convert string to dict for direct access to elements and modification
-    message = ast.literal_eval(message)
+# Synthesizes one greeting
+def synthesize_greeting(message):
     
     # Get Filename, Text from SNS
     fileName = message["File_name"]
     text = message["Text"]
     
-    print "Filename: " + fileName
-    print "Text: " + text
-
-    #invoke Polly API, which will transform text into audio
-    polly = boto3.client('polly')
-    response = polly.synthesize_speech(
-        OutputFormat='mp3',
-        Text = text,
-        VoiceId = 'Joey'
-    )
+    voice = message.get("Voice", defaultVoice)
+    outputFormat = message.get("Format", defaultFormat)
     
-    if "AudioStream" in response:
-        with closing(response["AudioStream"]) as stream:
-            output = os.path.join("/tmp/", fileName)
-            with open(output, "a") as file:
-                file.write(stream.read())
-                
-    # Upload the result from Polly Text-to-Speech to S3
-    print("Continuing with S3 Upload")
+    print("Filename: " + fileName)
+    print("Text: " + text)
     
     # define S3 paramaters
-    source = '/tmp/' + fileName
+    sharedurl = "mp3/" + greeting_file_name(text, voice, outputFormat)
     desturl = "mp3/" + fileName
     
-    # create S3 client
-    s3 = boto3.client('s3')
+    if exists(sharedurl):
+        print("Audio already synthesized: " + sharedurl)
+    else:
+        #invoke Polly API, which will transform text into audio
+        response = polly.synthesize_speech(
+            OutputFormat=outputFormat,
+            Text = text,
+            VoiceId = voice
+        )
+        
+        if "AudioStream" not in response:
+            raise RuntimeError("No audio stream in Polly response for " + fileName)
+        
+        # Upload the result from Polly Text-to-Speech to S3
+        print("Continuing with S3 Upload")
+        
+        # Stream the Polly audio to S3
+        with closing(response["AudioStream"]) as stream:
+            s3.upload_fileobj(stream,
+                              bucket,
+                              sharedurl,
+                              ExtraArgs={'ContentType': 'audio/mpeg'})
     
-    # Get the region for the bucket in order to determine the right URL format for S3 Object later
-    location = s3.get_bucket_location(Bucket=bucket)
-    region = location['LocationConstraint']
-    print ("S3 region:")
-    print(region)
-
-    # Upload Polly file to S3
-    s3.upload_file(source, 
-                   bucket, 
-                   desturl)
+    # Requested file name that is not the shared object
+    if desturl != sharedurl:
+        s3.copy_object(Bucket=bucket, Key=desturl, CopySource={'Bucket': bucket, 'Key': sharedurl})
+        print("Copied " + sharedurl + " to " + desturl)
     
-    return
\ No newline at end of file
+    return desturl
@@ -1,16 +1,26 @@
 # This script is triggered by an upload of a JPG file to the folder /index on S3
 # It triggers AWS Face Rekongnition to create a new index in the collection for the new face
-# If this is successful it creates a new entry in DynamoDB together with the Full Name (extracted from S3 Metadata for the file)
-# and the filename for the MP3 file that shall be used for this user
+# If this is successful it creates a new entry in DynamoDB together with the Full Name (taken from the object key,
+# index/<name>.jpg or index/<name>/<n>.jpg) and the filename for the MP3 file that shall be used for this user
+# Up to INDEX_MAX_FACES faces per image are indexed, faces of low quality are filtered out by Rekognition
+# The MP3 file name is derived from the greeting text, voice and format, persons with the same greeting share one MP3
+# All records of an S3 event are processed concurrently (lambda_records.py), e.g. for bulk enrollments
+# The DynamoDB entries of all faces of an invocation are written with BatchWriteItem and the greetings are sent in one SNS message
+# If the entries cannot be written (throttled after maxWriteRetries), the faces of the invocation are deleted from the collection
+# again and the invocation fails, so the retry of the S3 event indexes the images once more without duplicate faces
 # it further generates a SNS message that triggers the "LambdaGenerateVoiceMsgWithPolly" function, which generates the MP3 file and stores it on S3
 
 from __future__ import print_function
 
 import boto3
 from decimal import Decimal
+import hashlib
 import json
 import urllib
 import os
+import posixpath
+import time
+from lambda_records import process_records, summarize
 
 # Initialize Clients
 dynamodb = boto3.client('dynamodb')
@@ -22,104 +32,149 @@ sns = boto3.client('sns')
 tableName = os.environ["TABLE"]
 collectionName = os.environ["COLLECTION"]
 snsArn = os.environ["SNS_TOPIC_ARN"] 
+maxFaces = int(os.environ.get("INDEX_MAX_FACES", "1"))
+
+# Attempts for the unprocessed items of a BatchWriteItem request before the update fails
+maxWriteRetries = 5
+
+# Voice and format of the greetings
+greetingVoice = 'Joey'
+greetingFormat = 'mp3'
 
 # --------------- Helper Functions ------------------
-# Triggers a new index for a face with AWS Rekognition
+# File name of the audio for text, voice and format (same scheme as in LambdaGenerateVoiceMsgWithPolly)
+def greeting_file_name(text, voice, outputFormat):
+    digest = hashlib.sha256(json.dumps([text, voice, outputFormat]).encode('utf-8')).hexdigest()
+    return 'greeting-' + digest[:32] + '.' + outputFormat
+
+# Full name of the person from the object key (index/<name>.jpg or index/<name>/<n>.jpg)
+def parse_full_name(key):
+    folder, filename = posixpath.split(key)
+    if folder == "index":
+        return posixpath.splitext(filename)[0]
+    if posixpath.dirname(folder) == "index":
+        return posixpath.basename(folder)
+    return None
+
+# Triggers a new index for the faces in an image with AWS Rekognition
 def index_faces(bucket, key):
     response = rekognition.index_faces(
     Image={"S3Object":
       {"Bucket": bucket,
       "Name": key}},
-        CollectionId=collectionName)
+        CollectionId=collectionName,
+        MaxFaces=maxFaces,
+        QualityFilter='AUTO')
     return response
 
-# Updates DynamoDB entries for known users
-def update_index(tableName,faceId, fullName, fileName):
-    response = dynamodb.put_item(
-    TableName= tableName,
-    Item={
-      'RekognitionId': {'S': faceId},
-      'FullName': {'S': fullName},
-      'FileName': {'S': fileName}
-      }
-  )
-    return response
+# Updates DynamoDB entries for known users, 25 items per BatchWriteItem request
+def update_index(tableName, items):
+    for start in range(0, len(items), 25):
+        requests = [{'PutRequest': {'Item': {
+          'RekognitionId': {'S': faceId},
+          'FullName': {'S': fullName},
+          'FileName': {'S': fileName}
+          }}} for faceId, fullName, fileName in items[start:start + 25]]
+        retry = 0
+        while requests:
+            response = dynamodb.batch_write_item(RequestItems={tableName: requests})
+            requests = response.get('UnprocessedItems', {}).get(tableName, [])
+            if requests:
+                # throttled, back off before writing the rest
+                retry += 1
+                if retry > maxWriteRetries:
+                    raise RuntimeError("%d DynamoDB items not written after %d retries" % (len(requests), maxWriteRetries))
+                time.sleep(min(0.1 * 2 ** retry, 2))
+
+# Deletes faces from the collection, e.g. if their DynamoDB entries could not be written
+def delete_faces(faceIds):
+    for start in range(0, len(faceIds), 4096):
+        response = rekognition.delete_faces(CollectionId=collectionName, FaceIds=faceIds[start:start + 4096])
+        print("Deleted faces from the collection:")
+        print(response['DeletedFaces'])
 
 # --------------- Main handler ------------------
 
 def lambda_handler(event, context):
-    # Get the object from the event
+    results = process_records(event['Records'], index_record)
+    
+    # faces of all records: (faceId, fullName, fileName, text)
+    faces = [face for result in results if result['ok'] for face in result['result']['faces']]
+    keys = [result['result']['key'] for result in results if result['ok']]
     bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.unquote_plus(
-    event['Records'][0]['s3']['object']['key'].encode('utf8'))
     
-    print("S3 Key:"+key)
-    try:
-        # Calls Amazon Rekognition IndexFaces API to detect faces in S3 object
-        # to index faces into specified collection
-        response = index_faces(bucket, key)
+    if faces:
+        # create DynamoDB entries for the new faces
+        try:
+            update_index(tableName, [(faceId, fullName, fileName) for faceId, fullName, fileName, text in faces])
+        except Exception:
+            # the images are kept and indexed again by the retry, entries that were written point to deleted faces
+            # and never match
+            delete_faces([face[0] for face in faces])
+            raise
+        print("Added %d faces to DynamoDB" % len(faces))
         
-        # Commit faceId and full name object metadata to DynamoDB
-        if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-            
-            faceId = response['FaceRecords'][0]['Face']['FaceId']
-            print("FaceId:")
-            print(faceId)
-            # Define Filename for Mp3 (<faceid>.mp3)
-            
-            fileName = faceId+'.mp3'
-            # Head S3 object and extract the Full Name from the object metadata (was sent in x-amz-meta-fullname header during upload to S3)
-            ret = s3.head_object(Bucket=bucket,Key=key)
-            fullName = ret['Metadata']['fullname']
-            
-            print("S3 response for HEAD:")
-            print(ret)
-            print("Fullname extracted:")
-            print(fullName)
-            
-            # create DynamoDB entry for new Face
-            response = update_index(tableName,faceId,fullName, fileName)
-            
-            # Print response to console.
-            print("Update Dynamo DB response:")
-            print(response)
-            
-            # Define the text here that is used for the MP3 file
-            defaultText = 'Hey ' + fullName + '! Come in homie! Grab a beer and relax!'
-            
-            # Generate content for SNS Message, needs Filename and Text to synthesize
-            snsmsg={}
-            snsmsg['File_name'] = fileName
-            snsmsg['Text'] = defaultText
+        # Generate content for SNS Message, needs Filename and Text to synthesize for every greeting
+        greetings = {}
+        for faceId, fullName, fileName, text in faces:
+            greetings[fileName] = {'File_name': fileName, 'Text': text, 'Voice': greetingVoice, 'Format': greetingFormat}
+        snsmsg = {'Greetings': list(greetings.values())}
 
-            # convert dict/json back to string before sending as payload
-            strResponse = json.dumps(snsmsg)
-            print("strResponse:")
-            print(strResponse)
-            
-            # Publish message to the specified SNS topic
-            sns_response = sns.publish(
-                TopicArn=snsArn,    
-                Message=strResponse,
-            )
-            print("SNS Response:")
-            print(sns_response)
-            
-            # delete image on S3
-            try:
-                response = s3.delete_object(Bucket=bucket, Key=key)
-                
-                # Print response to console
-                print("Deleted image "+key+" from /index")
-                print("S3 reponse:")
-                print(response)
-                
-            except Exception as e:
-                print(e)
-                raise e
+        # convert dict/json back to string before sending as payload
+        strResponse = json.dumps(snsmsg)
+        print("strResponse:")
+        print(strResponse)
         
-        return response
-    except Exception as e:
-        print(e)
-        print("Error processing {} from bucket {}. ".format(key, bucket)) 
-        raise e
\ No newline at end of file
+        # Publish message to the specified SNS topic
+        sns_response = sns.publish(
+            TopicArn=snsArn,    
+            Message=strResponse,
+        )
+        print("SNS Response:")
+        print(sns_response)
+    
+    # delete the processed images on S3
+    for start in range(0, len(keys), 1000):
+        response = s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]]})
+        print("Deleted images from /index:")
+        print(response)
+    
+    return summarize(results)
+
+# Indexes the face of one S3 event record
+def index_record(record):
+    # Get the object from the event
+    bucket = record['s3']['bucket']['name']
+    key = urllib.unquote_plus(
+    record['s3']['object']['key'].encode('utf8'))
+    
+    print("S3 Key:"+key)
+    
+    # the full name is part of the object key
+    fullName = parse_full_name(key)
+    if not fullName:
+        raise ValueError("No name in object key " + key)
+    print("Fullname extracted:")
+    print(fullName)
+    
+    # Calls Amazon Rekognition IndexFaces API to detect faces in S3 object
+    # to index faces into specified collection
+    response = index_faces(bucket, key)
+    for unindexed in response.get('UnindexedFaces', []):
+        print("Face not indexed: " + ", ".join(unindexed['Reasons']))
+    if not response['FaceRecords']:
+        raise ValueError("No face of sufficient quality found in " + key)
+    
+    # Define the text here that is used for the MP3 file
+    defaultText = 'Hey ' + fullName + '! Come in homie! Grab a beer and relax!'
+    
+    # Define Filename for Mp3 (greeting-<hash>.mp3), shared by all faces with the same greeting
+    fileName = greeting_file_name(defaultText, greetingVoice, greetingFormat)
+    
+    faces = []
+    for faceRecord in response['FaceRecords']:
+        faceId = faceRecord['Face']['FaceId']
+        print("FaceId:")
+        print(faceId)
+        faces.append((faceId, fullName, fileName, defaultText))
+    return {'key': key, 'faces': faces}
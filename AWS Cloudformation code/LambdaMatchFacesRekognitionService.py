@@ -1,51 +1,93 @@
 # This script is triggered by the upload of a JPG image in the folder /matches on S3
+# The recognition id (recid) of the request is the file name of the object key: matches/<recid>.jpg
 # It compares the picutre against the collection of known faces with AWS FaceRekognition service
 # If a match is found it get's the Full Name and the filename for the corresponding MP3 from DynamoDB
 # it generates a presigned URL for the MP3 and sends it back in a IOT message to the client for playback
 # it sends the results of the face match action also as an IOT response to the client for further actions
+# RESULT_MODE selects the IOT messages: "combined" sends one versioned message with the result and the greeting URL
+# to doorbell/result, "legacy" sends rekognition/result and polly/result, "both" sends all of them (for migration)
+# Besides the S3 trigger the function can be invoked directly by the client with the image bytes and the recid
+# ({"Recid": "<recid>", "Image": "<base64 JPEG>"}), which skips the S3 upload, the S3 event and the DELETE call
+# The person details are cached per warm container for FACE_CACHE_TTL seconds, the TTL is the only bound on stale
+# entries (enrollments only add items with new RekognitionIds, changed or deleted items are seen after the TTL)
+# Presigned greeting URLs are cached per MP3 and reused while they are still valid for presignMinValidity seconds
+# All records of an S3 event are processed concurrently (lambda_records.py), each image is matched on its own
 
 from __future__ import print_function
 
 import boto3
+import base64
 from decimal import Decimal
 import json
 import urllib
 import os
 import botocore
-import datetime
-import re
+import posixpath
 import ast
+import time
+import threading
+from collections import OrderedDict
+from lambda_records import process_records, summarize
 
 # Initialize variables from env. variables
 collectionName = os.environ["COLLECTION"]
 regionName = os.environ["REGION"]
 tableName = os.environ["TABLE"]
+bucketName = os.environ.get("BUCKET_NAME")
+resultMode = os.environ.get("RESULT_MODE", "legacy")
+faceCacheTtl = int(os.environ.get("FACE_CACHE_TTL", "300"))
+faceCacheSize = int(os.environ.get("FACE_CACHE_SIZE", "500"))
 
 # Initialize client connections
 rekognition = boto3.client('rekognition')
 iot = boto3.client('iot-data')
 dynamodb = boto3.client('dynamodb', region_name=regionName)
+# region pinned client, the presigned URLs point to the regional endpoint
+s3 = boto3.client('s3', region_name=regionName)
 
 # Define FileName to be used if no match is found
 defaultMP3 = 'No_face_match.mp3'
 
-def getPresignedS3Url(bucket, desturl, region):
-    # Define URL format based on S3 region
-    # Create boto3 S3 client and get the pre-signed URL
+# Number of candidate faces requested from Rekognition, resolved with one DynamoDB BatchGetItem
+maxFaces = 3
+
+# Attempts for the unprocessed keys of a BatchGetItem request before the lookup fails
+maxReadRetries = 5
+
+# Version of the combined result message on doorbell/result
+resultVersion = 2
+
+# Person details of warm containers: RekognitionId -> (time of lookup, item with FullName/FileName), oldest first
+faceCache = OrderedDict()
+faceCacheStats = {'hits': 0, 'misses': 0}
+faceCacheLock = threading.Lock()
+
+# Presigned greeting URLs: (bucket, key) -> (expiry time, URL)
+presignExpiry = 600
+presignMinValidity = 120
+presignedUrls = {}
+
+def getPresignedS3Url(bucket, desturl):
+    # Get the pre-signed URL from the cache or sign a new one with the module S3 client
+    
+    now = time.time()
+    cached = presignedUrls.get((bucket, desturl))
+    if cached is not None and cached[0] - now > presignMinValidity:
+        print("Cached signed URL for S3 mp3:")
+        print(cached[1])
+        return cached[1]
     
     try:
-        s3 = boto3.client('s3')
-        session = boto3.Session()
-        s3 = session.client('s3', region_name=region)
         signedUrl = s3.generate_presigned_url(
             ClientMethod="get_object",
-            ExpiresIn=600,  # valid for 30 minutes
+            ExpiresIn=presignExpiry,  # valid for 10 minutes
             HttpMethod='GET',
             Params={
                 "Bucket": bucket,
                 "Key": desturl,
             }
         )
+        presignedUrls[(bucket, desturl)] = (now + presignExpiry, signedUrl)
         print("Signed URL for S3 mp3:")
         print(signedUrl)
 
@@ -72,33 +114,25 @@ def publishIotMessage(strtopic, strData):
         print(error.response['Error']['Code'])
         raise error
         return False
-#--------------- Helper Functions to call Rekognition APIs ------------------
 
-def default(obj):
-    """Default JSON serializer."""
-    import calendar, datetime
+def parse_recid(key):
+    # matches/<recid>.jpg -> <recid>, None if the key does not follow this format
+    folder, filename = posixpath.split(key)
+    recid, extension = posixpath.splitext(filename)
+    if folder != "matches" or not recid.isdigit():
+        return None
+    return recid
 
-    if isinstance(obj, datetime.datetime):
-        if obj.utcoffset() is not None:
-            obj = obj - obj.utcoffset()
-        millis = int(
-            calendar.timegm(obj.timetuple()) * 1000 +
-            obj.microsecond / 1000
-        )
-        return millis
-    raise TypeError('Not sure how to serialize %s' % (obj,))
-#------------------------------------------------------------------------------
+#--------------- Helper Functions to call Rekognition APIs ------------------
 
-def compare_faces(bucket, key, threshold=80):
+def compare_faces(image, threshold=80):
+    # image is either {"S3Object": {...}} or {"Bytes": ...}
     try:
         response = rekognition.search_faces_by_image(
             CollectionId=collectionName,
-            Image={
-                "S3Object": {
-                    "Bucket": bucket,
-                    "Name": key,
-                }
-            }
+            Image=image,
+            MaxFaces=maxFaces,
+            FaceMatchThreshold=threshold
         )
         print("Recognition Response:")
         print(response)
@@ -120,99 +154,128 @@ def compare_faces(bucket, key, threshold=80):
         faceItem = json.dumps({'Match_found': 'false', 'Full_name': 'none'})
         print(faceItem)
     else:
-        # Get person details from DynamoDB by matching with the FaceID as primary key (RekognitionId)
-        for match in response['FaceMatches']:
-            print (match['Face']['FaceId'],match['Face']['Confidence'])
-            face = dynamodb.get_item(TableName=tableName,Key={'RekognitionId': {'S': match['Face']['FaceId']}})
-            print("Response from DynamoDB query:")
-            print(face)
-            if 'Item' in face:
-                faceItem = json.dumps({'Match_found': 'true', 'Full_name': face['Item']['FullName']['S'], 'File_name': face['Item']['FileName']['S']})
-                
-                print("Face Item:")
-                print(faceItem)
+        # Get person details from DynamoDB by matching with the FaceIDs as primary key (RekognitionId)
+        # all candidates are fetched with one request, the known face with the highest similarity wins
+        matches = sorted(response['FaceMatches'], key=lambda match: (-match['Similarity'], match['Face']['FaceId']))
+        for match in matches:
+            print (match['Face']['FaceId'],match['Similarity'])
+        items = get_face_items([match['Face']['FaceId'] for match in matches])
+        print("Response from DynamoDB query:")
+        print(items)
+        faceItem = json.dumps({'Match_found': 'false', 'Full_name': 'none'})
+        for match in matches:
+            item = items.get(match['Face']['FaceId'])
+            if item is not None:
+                faceItem = json.dumps({'Match_found': 'true', 'Full_name': item['FullName']['S'], 'File_name': item['FileName']['S']})
+                break
+        print("Face Item:")
+        print(faceItem)
     return faceItem
 
-# --------------- Main handler ------------------
+def get_face_items(faceIds):
+    # Person details for faceIds from the cache, misses are fetched with one BatchGetItem
+    # returns a dict FaceId -> item
+    items = {}
+    now = time.time()
+    with faceCacheLock:
+        for faceId in set(faceIds):
+            cached = faceCache.get(faceId)
+            if cached is not None and now - cached[0] < faceCacheTtl:
+                items[faceId] = cached[1]
+                faceCacheStats['hits'] += 1
+            else:
+                faceCacheStats['misses'] += 1
 
+    keys = [{'RekognitionId': {'S': faceId}} for faceId in set(faceIds) if faceId not in items]
+    retry = 0
+    while keys:
+        if retry:
+            # throttled, back off before reading the rest
+            if retry > maxReadRetries:
+                raise RuntimeError("%d DynamoDB items not read after %d retries" % (len(keys), maxReadRetries))
+            time.sleep(min(0.1 * 2 ** retry, 2))
+        response = dynamodb.batch_get_item(RequestItems={tableName: {
+            'Keys': keys,
+            'ProjectionExpression': 'RekognitionId, FullName, FileName'}})
+        with faceCacheLock:
+            for item in response['Responses'].get(tableName, []):
+                faceId = item['RekognitionId']['S']
+                items[faceId] = item
+                faceCache.pop(faceId, None)
+                faceCache[faceId] = (now, item)
+            while len(faceCache) > faceCacheSize:
+                faceCache.popitem(last=False)
+        keys = response.get('UnprocessedKeys', {}).get(tableName, {}).get('Keys', [])
+        retry += 1
+    return items
 
-def lambda_handler(event, context):
-    print("Received event: " + json.dumps(event, indent=2))
+def log_face_cache(hits, misses):
+    # Logs the cache hit rate of this invocation
+    lookups = hits + misses
+    if lookups:
+        print("Face cache: %d hits, %d misses, hit rate %.0f%%, %d cached" % (hits, misses, 100.0 * hits / lookups, len(faceCache)))
+
+# --------------- Face match and IOT response ------------------
+
+# Matches the image against the collection and publishes the result for the client with recid
+def match_face(image, recid, bucket):
+    # compare faces
+    response = compare_faces(image)
+    print("Compare_Faces response:")
+    print(response)
     
-    #Get S3 Bucket name from event
-    bucket = event['Records'][0]['s3']['bucket']['name']
+    # convert string to dict for direct access to elements and modification
+    response = ast.literal_eval(response)
     
-    #Get S3 Key name from event
-    key = urllib.unquote_plus(event['Records'][0]['s3']['object']['key'].encode('utf8'))
-    print(key)
-
-    try: 
-        s3 = boto3.client('s3')
-        # HEAD to S3 object to get Metadata (recid) in response
-        s3response = s3.head_object(Bucket=bucket, Key=key)
-        
-        # format HTTP response
-        s3JsonResponse = json.dumps(s3response, default=default)
-        s3JsonResponse = s3JsonResponse.encode("ascii","replace") 
-        
-        # extract recid with regex search
-        matchObj = re.search(r'"recid": "(\d*)".*', s3JsonResponse)
-        if matchObj:
-            recid = matchObj.group(1)
-            print("RecID found:" + recid)
-        else:
-            print ("No RecID found!!")
+    # add RecID to the face match response for IOT message to the client
+    print("RecID for Payload")
+    print(recid)
+    response['Recid'] = recid
+    print("Iot message payload:")
+    print(response)
     
-    # throw excpetion if this fails
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == "404":
-            print("The object does not exist.")
-        else:
-            raise
+    # convert dict/json back to string before sending as payload
+    strResponse = json.dumps(response)
+    print("Iot message payload as string:")
+    print(strResponse)
     
-    try:
-        # compare faces
-        response = compare_faces(bucket, key)
-        print("Compare_Faces response:")
-        print(response)
-        
-        # convert string to dict for direct access to elements and modification
-        response = ast.literal_eval(response)
-        
-        # add RecID to the face match response for IOT message to the client
-        print("RecID for Payload")
-        print(recid)
-        response['Recid'] = recid
-        print("Iot message payload:")
-        print(response)
-        
-        # convert dict/json back to string before sending as payload
-        strResponse = json.dumps(response)
-        print("Iot message payload as string:")
-        print(strResponse)
-        
-        # send iot response with recognition results
-        
+    # get MP3 name from Dynamo DB with FaceID
+    # fallback to no_match_mp3 if no match was found
+    # generate S3 Presigned URL
+    # there is no greeting if no face was found in the image
+    if response['Match_found'] == "true":
+        mp3FileName = response['File_name']
+    elif response['Match_found'] == "false":
+        mp3FileName = defaultMP3
+    else:
+        mp3FileName = None
+    
+    s3url = False
+    if mp3FileName is not None:
+        s3url = getPresignedS3Url(bucket, "mp3/"+mp3FileName)
+        if s3url is False:
+            print("Error occured: S3 URL cannot be generated!")
+    
+    # send one combined iot response with recognition results and greeting URL
+    if resultMode in ("combined", "both"):
+        result = {}
+        result['Version'] = resultVersion
+        result['Recid'] = recid
+        result['Match_found'] = response['Match_found']
+        result['Full_name'] = response['Full_name']
+        result['File_name'] = mp3FileName
+        result['S3url'] = s3url or None
+        iotResponse = publishIotMessage("doorbell/result", json.dumps(result))
+        print("IOT Publish response for doorbell/result topic:")
+        print (iotResponse)
+    
+    # send iot responses with recognition results and greeting URL on separate topics
+    if resultMode in ("legacy", "both"):
         iotResponse = publishIotMessage("rekognition/result", strResponse)
         print("IOT Publish response for rekognition/result topic:")
         print (iotResponse)
-        
-        # get MP3 name from Dynamo DB with FaceID
-        # fallback to no_match_mp3 if no match was found
-        # generate S3 Presigned URL
-        # send url in IOT response
-
-        # If a face match was found use the "File_name" we got from DynamoDB entry 
-        if response['Match_found'] not in "false":
-            
-            mp3FileName = response['File_name'] 
-        # If no face match was found, use the default MP3 filename
-        else:
-            mp3FileName = defaultMP3
-        
-        s3url = getPresignedS3Url(bucket, "mp3/"+mp3FileName, regionName)
-        
-        if s3url is not False:
+    
+        if s3url:
             # create iot response data with S3 url and recid
             data = {}
             data['s3url'] = s3url
@@ -223,15 +286,58 @@ def lambda_handler(event, context):
             iotResponse = publishIotMessage("polly/result", strData)
             print("IOT Publish response for polly/result topic:")
             print (iotResponse)
+    return response
+
+# --------------- Main handler ------------------
+
+
+def lambda_handler(event, context):
+    
+    hits, misses = faceCacheStats['hits'], faceCacheStats['misses']
+    try:
+        return handle_image(event)
+    finally:
+        log_face_cache(faceCacheStats['hits'] - hits, faceCacheStats['misses'] - misses)
+
+def handle_image(event):
+    
+    # direct invocation by the client with the image bytes
+    if 'Records' not in event:
+        recid = event['Recid']
+        print("Received image for RecID " + recid + " with direct invocation")
+        image = {"Bytes": base64.b64decode(event['Image'])}
+        return match_face(image, recid, event.get('Bucket', bucketName))
+    
+    print("Received event: " + json.dumps(event, indent=2))
+    
+    return summarize(process_records(event['Records'], match_record))
+
+# Matches the image of one S3 event record
+def match_record(record):
+    
+    #Get S3 Bucket name from event
+    bucket = record['s3']['bucket']['name']
+    
+    #Get S3 Key name from event
+    key = urllib.unquote_plus(record['s3']['object']['key'].encode('utf8'))
+    print(key)
+
+    # the recid is part of the object key, no S3 request needed to learn who asked
+    recid = parse_recid(key)
+    if recid is None:
+        print("No RecID in object key " + key + ", ignoring the image")
+        return
+    print("RecID found:" + recid)
+    
+    try:
+        response = match_face({"S3Object": {"Bucket": bucket, "Name": key}}, recid, bucket)
         
-        else:
-            print("Error occured: S3 URL cannot be generated!")
-            
         try:
-            response = s3.delete_object(Bucket=bucket, Key=key)
+            s3.delete_object(Bucket=bucket, Key=key)
         except Exception as e:
             print(e)
             raise e
+        return response
     except Exception as e:
         print(e)
         raise e
\ No newline at end of file
@@ -0,0 +1,53 @@
+# Helper for the Lambda functions that are triggered by S3 or SNS events with several records
+# The records are processed concurrently by a bounded number of worker threads, every record gets its own
+# result, so one failing record does not fail the other records of the batch.
+# This module is packaged into the zip file of every Lambda function.
+
+from __future__ import print_function
+
+import os
+import threading
+import traceback
+
+# Number of worker threads per invocation
+maxWorkers = int(os.environ.get("RECORD_WORKERS", "4"))
+
+def process_records(records, handler, workers=None):
+    # Calls handler(record) for every record, returns a list of results in the order of records
+    # each result is a dict with 'ok' and either 'result' or 'error'
+    results = [None] * len(records)
+    nextIndex = [0]
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                index = nextIndex[0]
+                nextIndex[0] += 1
+            if index >= len(records):
+                return
+            try:
+                results[index] = {'ok': True, 'result': handler(records[index])}
+            except Exception as e:
+                traceback.print_exc()
+                results[index] = {'ok': False, 'error': str(e)}
+
+    workers = min(workers or maxWorkers, len(records))
+    if workers <= 1:
+        work()
+        return results
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def summarize(results):
+    # Prints the outcome of the batch and raises if no record succeeded, so single record events
+    # are retried by Lambda like before while partly failed batches do not reprocess the good records
+    failed = [result for result in results if not result['ok']]
+    print("Processed %d records, %d failed" % (len(results), len(failed)))
+    if results and len(failed) == len(results):
+        raise RuntimeError("All records failed: " + "; ".join(result['error'] for result in failed))
+    return results
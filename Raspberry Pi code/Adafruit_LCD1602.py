@@ -1,4 +1,4 @@
-from time import sleep
+from time import sleep, monotonic
 
 
 class Adafruit_CharLCD(object):
@@ -45,7 +45,14 @@ class Adafruit_CharLCD(object):
     LCD_5x10DOTS            = 0x04
     LCD_5x8DOTS             = 0x00
 
-    def __init__(self, pin_rs=25, pin_e=24, pins_db=[23, 17, 21, 22], GPIO=None):
+    # execution times (microseconds), the next byte is sent when the previous one is done
+    LCD_DELAY_WRITE         = 40        # characters and most commands take 37 us
+    LCD_DELAY_CLEAR         = 1600      # clear display and return home take 1.52 ms
+    LCD_DELAY_INIT          = 4100      # function set commands during the initialization
+    LCD_BUSY_POLL           = 200       # longer waits poll the busy flag if pin_rw is given
+    LCD_SPIN_WAIT           = 500       # shorter waits are spun, sleep() takes much longer than requested
+
+    def __init__(self, pin_rs=25, pin_e=24, pins_db=[23, 17, 21, 22], GPIO=None, pin_rw=None):
         # Emulate the old behavior of using RPi.GPIO if we haven't been given
         # an explicit GPIO interface to use
         if not GPIO:
@@ -55,6 +62,10 @@ class Adafruit_CharLCD(object):
         self.pin_rs = pin_rs
         self.pin_e = pin_e
         self.pins_db = pins_db
+        # pin_rw allows reading the busy flag, only for the PCF8574 expander whose pins can be read while high
+        self.pin_rw = pin_rw
+        self.busyUntil = 0.0
+        self._initializing = True
 
         self.GPIO.setmode(GPIO.BCM) #GPIO=None use Raspi PIN in BCM mode
         self.GPIO.setup(self.pin_e, GPIO.OUT)
@@ -62,9 +73,13 @@ class Adafruit_CharLCD(object):
 
         for pin in self.pins_db:
             self.GPIO.setup(pin, GPIO.OUT)
+        if self.pin_rw is not None:
+            self.GPIO.setup(self.pin_rw, GPIO.OUT)
+            self.GPIO.output(self.pin_rw, False)
 
         self.write4bits(0x33)  # initialization
         self.write4bits(0x32)  # initialization
+        self._initializing = False
         self.write4bits(0x28)  # 2 line 5x7 matrix
         self.write4bits(0x0C)  # turn cursor off 0x0E to enable cursor
         self.write4bits(0x06)  # shift cursor right
@@ -86,12 +101,10 @@ class Adafruit_CharLCD(object):
             self.displayfunction |= self.LCD_2LINE
 
     def home(self):
-        self.write4bits(self.LCD_RETURNHOME)  # set cursor position to zero
-        self.delayMicroseconds(3000)  # this command takes a long time!
+        self.write4bits(self.LCD_RETURNHOME)  # set cursor position to zero, the next write waits until it is done
 
     def clear(self):
-        self.write4bits(self.LCD_CLEARDISPLAY)  # command to clear display
-        self.delayMicroseconds(3000)  # 3000 microsecond sleep, clearing the display takes a long time
+        self.write4bits(self.LCD_CLEARDISPLAY)  # command to clear display, the next write waits until it is done
 
     def setCursor(self, col, row):
         self.row_offsets = [0x00, 0x40, 0x14, 0x54]
@@ -157,35 +170,84 @@ class Adafruit_CharLCD(object):
         self.displaymode &= ~self.LCD_ENTRYSHIFTINCREMENT
         self.write4bits(self.LCD_ENTRYMODESET | self.displaymode)
 
+    def commandDelay(self, bits, char_mode=False):
+        """ Returns the execution time of a command or character in microseconds """
+        if self._initializing:
+            return self.LCD_DELAY_INIT
+        if not char_mode and bits in (self.LCD_CLEARDISPLAY, self.LCD_RETURNHOME):
+            return self.LCD_DELAY_CLEAR
+        return self.LCD_DELAY_WRITE
+
+    def setBusy(self, bits, char_mode=False):
+        """ Records until when the LCD executes the byte that was just sent """
+        self.busyUntil = monotonic() + self.commandDelay(bits, char_mode) / 1000000.0
+
+    def waitReady(self):
+        """ Waits until the previous byte is executed, time spent since then counts towards the delay """
+        remaining = (self.busyUntil - monotonic()) * 1000000
+        if remaining <= 0:
+            return
+        if self.pin_rw is not None and remaining > self.LCD_BUSY_POLL:
+            if self.pollBusy(2 * remaining / 1000000.0):
+                return
+        elif remaining > self.LCD_SPIN_WAIT:
+            sleep(remaining / 1000000.0)
+            return
+        while monotonic() < self.busyUntil:
+            pass
+
+    def pollBusy(self, timeout):
+        """ Reads the busy flag until it is cleared, returns False on timeout """
+        deadline = monotonic() + timeout
+        self.outputs([self.pin_rs, self.pin_rw] + self.pins_db, [False, True, True, True, True, True])
+        try:
+            while True:
+                self.GPIO.output(self.pin_e, True)
+                busy = self.inputUncached(self.pins_db[3])  # busy flag is DB7 of the high nibble
+                self.GPIO.output(self.pin_e, False)
+                self.GPIO.output(self.pin_e, True)          # low nibble (address counter) is not needed
+                self.GPIO.output(self.pin_e, False)
+                if not busy:
+                    return True
+                if monotonic() > deadline:
+                    return False
+        finally:
+            self.GPIO.output(self.pin_rw, False)
+
+    def inputUncached(self, pin):
+        """ Reads a pin from the bus, a read cache of the GPIO interface (PCF8574_GPIO readInterval) is bypassed """
+        if hasattr(self.GPIO, 'input_uncached'):
+            return self.GPIO.input_uncached(pin)
+        return self.GPIO.input(pin)
+
+    def outputs(self, pins, values):
+        """ Sets several pins, with one bus write if the GPIO interface supports it (PCF8574_GPIO) """
+        if hasattr(self.GPIO, 'output_many'):
+            self.GPIO.output_many(pins, values)
+        else:
+            for pin, value in zip(pins, values):
+                self.GPIO.output(pin, value)
+
     def write4bits(self, bits, char_mode=False):
         """ Send command to LCD """
-        self.delayMicroseconds(1000)  # 1000 microsecond sleep
-        bits = bin(bits)[2:].zfill(8)
-        self.GPIO.output(self.pin_rs, char_mode)
-        for pin in self.pins_db:
-            self.GPIO.output(pin, False)
-        for i in range(4):
-            if bits[i] == "1":
-                self.GPIO.output(self.pins_db[::-1][i], True)
-        self.pulseEnable()
-        for pin in self.pins_db:
-            self.GPIO.output(pin, False)
-        for i in range(4, 8):
-            if bits[i] == "1":
-                self.GPIO.output(self.pins_db[::-1][i-4], True)
-        self.pulseEnable()
+        self.waitReady()
+        pins = [self.pin_rs] + self.pins_db
+        for nibble in (bits >> 4, bits & 0x0F):
+            # bit i of the nibble goes to pins_db[i]
+            self.outputs(pins, [char_mode] + [(nibble >> i) & 1 == 1 for i in range(4)])
+            self.pulseEnable()
+        self.setBusy(bits, char_mode)
 
     def delayMicroseconds(self, microseconds):
         seconds = microseconds / float(1000000)  # divide microseconds by 1 million for seconds
         sleep(seconds)
 
     def pulseEnable(self):
+        # enable pulse must be > 450ns, a GPIO call takes longer than that, so no pause is needed
+        # commands need > 37us to settle, the next write4bits waits for it
         self.GPIO.output(self.pin_e, False)
-        self.delayMicroseconds(1)       # 1 microsecond pause - enable pulse must be > 450ns
         self.GPIO.output(self.pin_e, True)
-        self.delayMicroseconds(1)       # 1 microsecond pause - enable pulse must be > 450ns
         self.GPIO.output(self.pin_e, False)
-        self.delayMicroseconds(1)       # commands need > 37us to settle
 
     def message(self, text):
         """ Send string to LCD. Newline wraps to second line"""
@@ -196,6 +258,67 @@ class Adafruit_CharLCD(object):
                 self.write4bits(ord(char), True)
 
 
+class PCF8574_CharLCD(Adafruit_CharLCD):
+    """ LCD on a PCF8574 I2C expander (PCF8574_GPIO), every byte is sent as one precomputed sequence
+
+    Each LCD byte becomes 4 expander bytes (high nibble with E high/low, low nibble with E high/low),
+    looked up from a table. A message is sent with block writes of 33 expander bytes, i.e. 8 characters
+    per I2C transaction instead of more than a dozen transactions per character. The transfer of one
+    expander byte takes longer than the 37 us an LCD character or command needs, so no sleeps are needed
+    between the bytes. Pins that are not used by the LCD (e.g. the backlight) keep their current value.
+    With pin_rw (1 on the usual LCD1602 I2C modules) clear and home poll the busy flag instead of waiting.
+    """
+
+    def __init__(self, pin_rs=0, pin_e=2, pins_db=[4, 5, 6, 7], GPIO=None, pin_rw=None):
+        self.chip = GPIO.chip
+        self._lcdMask = (1 << pin_rs) | (1 << pin_e)
+        if pin_rw is not None:
+            self._lcdMask |= 1 << pin_rw
+        for pin in pins_db:
+            self._lcdMask |= 1 << pin
+        # expander bytes of every LCD byte without the other pins: [rs * 256 + value] -> 4 bytes
+        self._sequences = []
+        for rs in (0, 1):
+            for value in range(256):
+                sequence = []
+                for nibble in (value >> 4, value & 0x0F):
+                    bits = rs << pin_rs
+                    for i in range(4):
+                        if nibble & (1 << i):
+                            bits |= 1 << pins_db[i]
+                    sequence += [bits | (1 << pin_e), bits]
+                self._sequences.append(sequence)
+        self._tables = {}
+        Adafruit_CharLCD.__init__(self, pin_rs, pin_e, pins_db, GPIO, pin_rw)
+
+    def _table(self):
+        """ Returns the expander byte sequences for the current value of the other pins """
+        other = self.chip.currentValue & ~self._lcdMask & 0xFF
+        table = self._tables.get(other)
+        if table is None:
+            table = [bytes(bits | other for bits in sequence) for sequence in self._sequences]
+            self._tables[other] = table
+        return table
+
+    def write4bits(self, bits, char_mode=False):
+        """ Send command or character to LCD in one I2C transaction """
+        self.waitReady()
+        with self.chip.lock:
+            self.chip.writeBlock(self._table()[(256 if char_mode else 0) + bits])
+        self.setBusy(bits, char_mode)
+
+    def message(self, text):
+        """ Send string to LCD. Newline wraps to second line"""
+        self.waitReady()
+        with self.chip.lock:
+            # the other pins (e.g. backlight) must not change between building and writing the sequence
+            table = self._table()
+            sequence = b''.join(table[0xC0] if char == '\n' else table[256 + (ord(char) if ord(char) < 256 else 0x3F)]
+                                for char in text)
+            self.chip.writeBlock(sequence)
+        self.setBusy(0, True)
+
+
 if __name__ == '__main__':
     lcd = Adafruit_CharLCD()
     lcd.clear()
@@ -6,36 +6,96 @@
 ########################################################################
 import smbus
 import time
+import threading
+from contextlib import contextmanager
 class PCF8574_I2C(object):
 	OUPUT = 0
 	INPUT = 1
+	BLOCK_SIZE = 33	# SMBus block write: command byte + 32 data bytes, the PCF8574 latches every byte
 	
-	def __init__(self,address):
+	def __init__(self,address,readInterval=0):
 		# Note you need to change the bus number to 0 if running on a revision 1 Raspberry Pi.
 		self.bus = smbus.SMBus(1)
 		self.address = address
 		self.currentValue = 0
+		self.transactions = 0	# number of I2C write transactions
+		self.readInterval = readInterval	# seconds a port read is reused, 0 reads the port every time
+		self.lock = threading.RLock()	# the LCD, the backlight and LEDs can share the chip from several threads
+		self._depth = 0	# nesting level of transaction()
+		self._dirty = False	# currentValue was changed in a transaction and not written yet
+		self._readValue = 0
+		self._readTime = None
 		self.writeByte(0)	#I2C test.
 		
-	def readByte(self):#Read PCF8574 all port of the data
-		#value = self.bus.read_byte(self.address)
-		return self.currentValue#value
+	@contextmanager
+	def transaction(self):#Coalesce all writes in the block into one bus write at its end
+		with self.lock:
+			self._depth += 1
+			try:
+				yield self
+			finally:
+				self._depth -= 1
+				if self._depth == 0:
+					self.flush()
+					
+	def flush(self):#Write the value that was set in a transaction
+		with self.lock:
+			if self._dirty:
+				self._dirty = False
+				self.bus.write_byte(self.address,self.currentValue)
+				self.transactions += 1
+				self._readTime = None	#written pins change what the port reads
+				
+	def readByte(self,cached=True):#Read PCF8574 all port of the data, cached for readInterval seconds until the next write
+		with self.lock:
+			now = time.time()
+			if not cached or self._readTime is None or now - self._readTime >= self.readInterval:
+				self._readValue = self.bus.read_byte(self.address)	#pins that are written low always read low
+				self._readTime = now
+			return self._readValue
 		
 	def writeByte(self,value):#Write data to PCF8574 port
-		self.currentValue = value
-		self.bus.write_byte(self.address,value)
+		with self.lock:
+			if value == self.currentValue and self._depth and not self._dirty:
+				return
+			self.currentValue = value
+			if self._depth:
+				self._dirty = True
+				return
+			self.bus.write_byte(self.address,value)
+			self.transactions += 1
+			self._readTime = None
+		
+	def writeBlock(self,values):#Write a sequence of port values, up to 33 values per I2C transaction
+		with self.lock:
+			self.flush()
+			for start in range(0,len(values),self.BLOCK_SIZE):
+				chunk = values[start:start+self.BLOCK_SIZE]
+				if len(chunk) == 1:
+					self.bus.write_byte(self.address,chunk[0])
+				else:
+					self.bus.write_i2c_block_data(self.address,chunk[0],list(chunk[1:]))
+				self.transactions += 1
+			if len(values):
+				self.currentValue = values[-1]
+				self._readTime = None
 
-	def digitalRead(self,pin):#Read PCF8574 one port of the data
-		value = readByte()	
+	def digitalRead(self,pin,cached=True):#Read PCF8574 one port of the data
+		value = self.readByte(cached)	
 		return (value&(1<<pin)==(1<<pin)) and 1 or 0
 		
 	def digitalWrite(self,pin,newvalue):#Write data to PCF8574 one port
-		value = self.currentValue #bus.read_byte(address)
-		if(newvalue == 1):
-			value |= (1<<pin)
-		elif (newvalue == 0):
-			value &= ~(1<<pin)
-		self.writeByte(value)	
+		self.writeMany({pin: newvalue})
+		
+	def writeMany(self,pinValues):#Write several ports of the PCF8574 with one bus write
+		with self.lock:
+			value = self.currentValue #bus.read_byte(address)
+			for pin, newvalue in pinValues.items():
+				if(newvalue == 1):
+					value |= (1<<pin)
+				elif (newvalue == 0):
+					value &= ~(1<<pin)
+			self.writeByte(value)	
 
 def loop():
 	mcp = PCF8574_I2C(0x27)
@@ -54,8 +114,8 @@ class PCF8574_GPIO(object):#Standardization function interface
 	IN = 1
 	BCM = 0
 	BOARD = 0
-	def __init__(self,address):
-		self.chip = PCF8574_I2C(address)
+	def __init__(self,address,readInterval=0):
+		self.chip = PCF8574_I2C(address,readInterval)
 		self.address = address
 	def setmode(self,mode):#PCF8574 port belongs to two-way IO, do not need to set the input and output model
 		pass
@@ -63,8 +123,14 @@ class PCF8574_GPIO(object):#Standardization function interface
 		pass
 	def input(self,pin):#Read PCF8574 one port of the data
 		return self.chip.digitalRead(pin)
+	def input_uncached(self,pin):#Read PCF8574 one port of the data from the bus, e.g. a status flag that changes by itself
+		return self.chip.digitalRead(pin,False)
 	def output(self,pin,value):#Write data to PCF8574 one port
 		self.chip.digitalWrite(pin,value)
+	def output_many(self,pins,values):#Write data to several PCF8574 ports with one bus write
+		self.chip.writeMany(dict(zip(pins,values)))
+	def transaction(self):#Coalesce the outputs in a with block into one bus write
+		return self.chip.transaction()
 		
 def destroy():
 	bus.close()
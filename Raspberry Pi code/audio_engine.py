@@ -0,0 +1,93 @@
+# Persistent audio engine for the smart doorbell
+# The pygame mixer is initialized once at startup. Decoded Sound objects of the default greeting and of the
+# recently played greetings are kept in memory (LRU), so a greeting starts without loading it from disk.
+# Playback runs on a worker thread, play() never blocks the caller.
+# Decoding MP3 files into Sound objects requires pygame 2.
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+import pygame
+from metrics import metrics
+
+
+class AudioEngine(object):
+    """ Plays greetings from an in-memory LRU of decoded sounds """
+
+    def __init__(self, maxSounds=8, frequency=44100, size=-16, channels=2, buffer=2048, metrics=metrics):
+        self.maxSounds = maxSounds
+        self.metrics = metrics
+        pygame.mixer.pre_init(frequency, size, channels, buffer)  # setup mixer to avoid sound lag
+        pygame.mixer.init()
+        self._sounds = OrderedDict()    # key -> (file modification time, Sound), oldest first
+        self._pinned = set()            # preloaded sounds are never evicted
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._pending = 0               # sounds queued that have not started yet
+        self._started = threading.Event()
+        self._started.set()
+        self._thread = threading.Thread(target=self._playLoop, name="audio")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _sound(self, key, path):
+        """ Returns the decoded sound for key, (re)loads it if it is missing or the file changed """
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            cached = self._sounds.get(key)
+            if cached is not None and cached[0] == mtime:
+                self._sounds.move_to_end(key)
+                self.metrics.increment('audio.sound_hits')
+                return cached[1]
+        sound = pygame.mixer.Sound(path)
+        self.metrics.increment('audio.sound_loads')
+        with self._lock:
+            self._sounds[key] = (mtime, sound)
+            self._sounds.move_to_end(key)
+            evictable = [k for k in self._sounds if k not in self._pinned]
+            while len(self._sounds) > self.maxSounds and evictable:
+                del self._sounds[evictable.pop(0)]
+        return sound
+
+    def preload(self, key, path):
+        """ Decodes a sound now and keeps it in memory for good (e.g. the default greeting) """
+        self._pinned.add(key)
+        self._sound(key, path)
+
+    def play(self, key, path):
+        """ Queues the sound for playback and returns immediately """
+        with self._lock:
+            self._pending += 1
+            self._started.clear()
+        self._queue.put((key, path, time.time()))
+
+    def waitStarted(self, timeout=2):
+        """ Waits until the queued sounds have started (or failed), returns False on timeout """
+        return self._started.wait(timeout)
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join(2)
+        pygame.mixer.quit()
+
+    def _playLoop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            key, path, requested = item
+            try:
+                sound = self._sound(key, path)
+                pygame.mixer.stop()     # a new greeting replaces the one that is playing
+                sound.play()
+                latency = time.time() - requested
+                self.metrics.timing('audio.playback_start', latency)
+                logging.info("Playing %s, playback started after %.1f ms", key, latency * 1000)
+            except (pygame.error, OSError) as e:
+                logging.error("Playback of %s failed: %s", key, e)
+            with self._lock:
+                self._pending -= 1
+                if not self._pending:
+                    self._started.set()
@@ -0,0 +1,91 @@
+# Long-lived AWS client layer for the smart doorbell
+# The S3 client (photo upload) and the HTTP connection pool (greeting download) are created once at startup,
+# pre-warmed and kept alive, so a ring does not pay client construction, DNS lookups and TLS handshakes
+# If a match function is given, the Lambda client for the direct image submission is kept warm as well
+import logging
+import socket
+import threading
+import boto3
+import urllib3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+class DoorbellSession(object):
+    """ Shared boto3 session, S3 client and keep-alive connection pool """
+
+    def __init__(self, access_key_id, secret_access_key, bucket_name, region=None, keepAliveInterval=15, maxConnections=4, matchFunction=None):
+        self.bucket_name = bucket_name
+        self.keepAliveInterval = keepAliveInterval
+        self.matchFunction = matchFunction
+        self.session = boto3.Session(aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key, region_name=region)
+        config = Config(max_pool_connections=maxConnections, tcp_keepalive=True)
+        self.s3 = self.session.client('s3', config=config)
+        self.lambdaClient = None
+        if matchFunction:
+            self.lambdaClient = self.session.client('lambda', config=config)
+
+        # greeting MP3s are fetched with presigned URLs, the pool keeps these connections open
+        socketOptions = urllib3.connection.HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        self.http = urllib3.PoolManager(maxsize=maxConnections, socket_options=socketOptions,
+                                        timeout=urllib3.Timeout(connect=3, read=10), retries=urllib3.Retry(2))
+        # host of the presigned URLs, the first download replaces the guess with the real one
+        self.greetingHost = "https://" + bucket_name + ".s3.amazonaws.com/"
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def prewarm(self):
+        """ Opens (or refreshes) the connections to the S3 endpoints """
+        try:
+            self.s3.head_bucket(Bucket=self.bucket_name)
+        except (BotoCoreError, ClientError) as e:
+            # an access error still leaves a warm TLS connection behind
+            logging.debug("S3 pre-warm: %s", e)
+        if self.lambdaClient is not None:
+            try:
+                self.lambdaClient.get_function_configuration(FunctionName=self.matchFunction)
+            except (BotoCoreError, ClientError) as e:
+                logging.debug("Lambda pre-warm: %s", e)
+        try:
+            self.http.request('HEAD', self.greetingHost, retries=False)
+        except urllib3.exceptions.HTTPError as e:
+            logging.debug("Greeting host pre-warm: %s", e)
+
+    def startKeepAlive(self):
+        """ Refreshes the connections periodically so the first ring after idle finds them open """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._keepAliveLoop, name="aws-keepalive")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(2)
+        self._thread = None
+
+    def _keepAliveLoop(self):
+        while not self._stop.wait(self.keepAliveInterval):
+            self.prewarm()
+
+    def invokeMatch(self, payload):
+        """ Invokes the match function asynchronously, the result arrives via IoT like for S3 uploads """
+        self.lambdaClient.invoke(FunctionName=self.matchFunction, InvocationType='Event', Payload=payload)
+
+    def fetch(self, url, headers=None):
+        """ GET of a presigned URL over the shared connection pool, returns the response for any status """
+        response = self.http.request('GET', url, headers=headers)
+        parsed = urllib3.util.parse_url(url)
+        self.greetingHost = "%s://%s/" % (parsed.scheme, parsed.netloc)
+        return response
+
+    def download(self, url):
+        """ Downloads a presigned URL over the shared connection pool and returns the content """
+        response = self.fetch(url)
+        if response.status >= 400:
+            raise IOError("Download failed with HTTP status %d" % response.status)
+        return response.data
@@ -0,0 +1,205 @@
+# Camera pipeline for the smart doorbell
+# Two capture modes are supported:
+#   - still: the photo is taken on the still port when it is needed (sensor mode switch + exposure settling on every ring)
+#   - ring:  the camera captures continuously on the video port and keeps the last N decoded RGB frames
+#            in a bounded ring buffer, so the frame for the recognition is available the instant it is requested
+# With a burst count > 1 several frames are taken (or taken from the ring buffer), scored for sharpness
+# and exposure and only the best one is used.
+# Decoded frames are encoded by the optional encoder (crop to the face, size and byte budget, see image_encoder.py).
+import threading
+import time
+import logging
+import numpy as np
+from PIL import Image
+from frame_scoring import FrameScorer
+
+CAPTURE_MODES = ('still', 'ring')
+
+
+def paddedResolution(width, height):
+    """ Raw captures are padded by the camera to a multiple of 32 (width) and 16 (height) """
+    return ((width + 31) // 32 * 32, (height + 15) // 16 * 16)
+
+
+class FrameRingBuffer(object):
+    """ Bounded ring buffer of preallocated RGB frames
+
+    The writer always fills the oldest slot, readers only get copies of committed frames,
+    so the buffer needs at least two slots.
+    """
+
+    def __init__(self, size, width, height):
+        if size < 2:
+            raise ValueError("Ring buffer needs at least 2 frames, got %d" % size)
+        self.size = size
+        self.width = width
+        self.height = height
+        paddedWidth, paddedHeight = paddedResolution(width, height)
+        self._frames = np.empty((size, paddedHeight, paddedWidth, 3), dtype=np.uint8)
+        self._timestamps = [0.0] * size
+        self._next = 0
+        self._count = 0
+        self._condition = threading.Condition()
+
+    def writeSlot(self):
+        """ Returns the (padded) slot the next frame is written to """
+        return self._frames[self._next]
+
+    def commit(self):
+        """ Publishes the frame in the current write slot and moves on to the next slot """
+        with self._condition:
+            self._timestamps[self._next] = time.time()
+            self._next = (self._next + 1) % self.size
+            self._count = min(self._count + 1, self.size)
+            self._condition.notify_all()
+
+    def __len__(self):
+        # the slot that is currently written is never handed out
+        return min(self._count, self.size - 1)
+
+    def latest(self, timeout=None):
+        """ Returns (timestamp, frame) of the newest frame or None if no frame arrived within timeout """
+        frames = self.newest(1, timeout)
+        return frames[0] if frames else None
+
+    def newest(self, count, timeout=None):
+        """ Returns up to count (timestamp, frame) copies, newest first """
+        with self._condition:
+            if not self._count:
+                self._condition.wait(timeout)
+            count = min(count, len(self))
+            result = []
+            for i in range(1, count + 1):
+                slot = (self._next - i) % self.size
+                frame = self._frames[slot, :self.height, :self.width].copy()
+                result.append((self._timestamps[slot], frame))
+            return result
+
+
+class _SlotWriter(object):
+    """ File-like output for capture_continuous() that writes every frame into the next ring buffer slot """
+
+    def __init__(self, ring):
+        self._ring = ring
+        self._view = None
+        self._offset = 0
+
+    def write(self, data):
+        if self._view is None:
+            self._view = self._ring.writeSlot().reshape(-1)
+            self._offset = 0
+        size = min(len(data), self._view.size - self._offset)
+        self._view[self._offset:self._offset + size] = np.frombuffer(data, dtype=np.uint8, count=size)
+        self._offset += size
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def commit(self):
+        # only publish complete frames
+        if self._view is not None and self._offset == self._view.size:
+            self._ring.commit()
+        self._view = None
+
+
+class CameraPipeline(object):
+    """ Switchable capture pipeline on top of a PiCamera instance """
+
+    def __init__(self, camera, mode='still', ringSize=4, ringFramerate=10, frameTimeout=2, burstCount=1, encoder=None):
+        if mode not in CAPTURE_MODES:
+            raise ValueError("Unknown capture mode '%s', use one of %s" % (mode, ", ".join(CAPTURE_MODES)))
+        self.camera = camera
+        self.mode = mode
+        self.ringFramerate = ringFramerate
+        self.frameTimeout = frameTimeout
+        self.burstCount = max(1, burstCount)
+        self.encoder = encoder
+        self.lastEncoding = None
+        self.width, self.height = camera.resolution
+        self.ring = None
+        if mode == 'ring':
+            # the slot that is currently written can't be part of a burst
+            self.ring = FrameRingBuffer(max(ringSize, self.burstCount + 1), self.width, self.height)
+        self.scorer = None
+        self.lastScore = None
+        self._burstFrames = None
+        self._stillFrame = None
+        if self.burstCount > 1:
+            self.scorer = FrameScorer(self.width, self.height)
+            if mode == 'still':
+                paddedWidth, paddedHeight = paddedResolution(self.width, self.height)
+                self._burstFrames = np.empty((self.burstCount, paddedHeight, paddedWidth, 3), dtype=np.uint8)
+        self._running = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Starts the continuous video port capture (ring mode only) """
+        if self.mode != 'ring' or self._thread is not None:
+            return
+        self.camera.framerate = self.ringFramerate
+        self._running.set()
+        self._thread = threading.Thread(target=self._captureLoop, name="camera-ring")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._running.clear()
+        self._thread.join(2)
+        self._thread = None
+
+    def _captureLoop(self):
+        writer = _SlotWriter(self.ring)
+        try:
+            for _ in self.camera.capture_continuous(writer, format='rgb', use_video_port=True):
+                writer.commit()
+                if not self._running.is_set():
+                    break
+        except Exception as e:
+            logging.error("Ring buffer capture stopped: %s", e)
+
+    def captureBurst(self):
+        """ Returns burstCount RGB frames, from the ring buffer or captured in a row on the video port """
+        if self.mode == 'ring':
+            return [frame for timestamp, frame in self.ring.newest(self.burstCount, self.frameTimeout)]
+        self.camera.capture_sequence(list(self._burstFrames), format='rgb', use_video_port=True)
+        return [frame[:self.height, :self.width] for frame in self._burstFrames]
+
+    def captureFrame(self):
+        """ Returns the RGB frame for the recognition: best burst frame, newest ring buffer frame or a still capture """
+        if self.burstCount > 1:
+            frames = self.captureBurst()
+            if frames:
+                index, self.lastScore = self.scorer.best(frames)
+                logging.info("Burst frame %d of %d selected (sharpness %.1f, brightness %.1f)",
+                             index + 1, len(frames), self.lastScore.sharpness, self.lastScore.brightness)
+                return frames[index]
+            logging.warning("No burst frames available, falling back to single capture")
+        if self.mode == 'ring':
+            latest = self.ring.latest(self.frameTimeout)
+            if latest is not None:
+                timestamp, frame = latest
+                return frame
+            logging.warning("No frame in ring buffer, falling back to still capture")
+        if self._stillFrame is None:
+            paddedWidth, paddedHeight = paddedResolution(self.width, self.height)
+            self._stillFrame = np.empty((paddedHeight, paddedWidth, 3), dtype=np.uint8)
+        self.camera.capture(self._stillFrame, format='rgb')
+        return self._stillFrame[:self.height, :self.width]
+
+    def encode(self, frame, output, face=None):
+        """ Writes an RGB frame as JPEG to output (file name or writable stream), cropped to the face box if given """
+        if self.encoder is not None:
+            self.lastEncoding = self.encoder.encode(frame, output, face)
+            return
+        Image.fromarray(frame).save(output, 'JPEG')
+
+    def capture(self, output):
+        """ Writes the photo for the recognition as JPEG to output (file name or writable stream) """
+        if self.mode == 'still' and self.burstCount == 1:
+            # the camera encodes the JPEG itself, no need to decode the frame
+            self.camera.capture(output, format='jpeg')
+            return
+        self.encode(self.captureFrame(), output)
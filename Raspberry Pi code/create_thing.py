@@ -175,7 +175,7 @@ def create_iot_policy(thing_name):
         awsAccount = boto3.client('sts',aws_access_key_id=access_key_id,aws_secret_access_key=secret_access_key,region_name=region).get_caller_identity().get('Account')       
         
         # Create IOT Policy Document with required access for Face Recognition Service 
-        # (topics:/rekognition/result and /polly/result)
+        # (topics:/rekognition/result and /polly/result, /doorbell/result for the combined result message)
         policyDocumentStr = '''
             {
                 "Version": "2012-10-17",
@@ -187,7 +187,8 @@ def create_iot_policy(thing_name):
                         ],
                         "Resource": [
                             "arn:aws:iot:%s:%s:topic/rekognition/result",
-                            "arn:aws:iot:%s:%s:topic/polly/result"
+                            "arn:aws:iot:%s:%s:topic/polly/result",
+                            "arn:aws:iot:%s:%s:topic/doorbell/result"
                         ]
                     },
                     {
@@ -197,7 +198,8 @@ def create_iot_policy(thing_name):
                         ],
                         "Resource": [
                             "arn:aws:iot:%s:%s:topicfilter/rekognition/result",
-                            "arn:aws:iot:%s:%s:topicfilter/polly/result"
+                            "arn:aws:iot:%s:%s:topicfilter/polly/result",
+                            "arn:aws:iot:%s:%s:topicfilter/doorbell/result"
                         ]
                     },
                     {
@@ -207,7 +209,8 @@ def create_iot_policy(thing_name):
                         ],
                         "Resource": [
                             "arn:aws:iot:%s:%s:topic/rekognition/result",
-                            "arn:aws:iot:%s:%s:topic/polly/result"
+                            "arn:aws:iot:%s:%s:topic/polly/result",
+                            "arn:aws:iot:%s:%s:topic/doorbell/result"
                         ]
                     },
                     {
@@ -221,7 +224,7 @@ def create_iot_policy(thing_name):
                     }
                 ]
             }
-        '''%(awsRegion, awsAccount, awsRegion, awsAccount, awsRegion, awsAccount,awsRegion, awsAccount, awsRegion, awsAccount, awsRegion, awsAccount,awsRegion, awsAccount, awsRegion, awsAccount, awsRegion, awsAccount)
+        '''%((awsRegion, awsAccount) * 12)
         pattern = re.compile(r'[\s\r\n]+')
         policyDocumentStr = re.sub(pattern, '', policyDocumentStr)
         
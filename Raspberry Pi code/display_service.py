@@ -0,0 +1,120 @@
+# Display worker for the smart doorbell
+# The LCD is only written by one worker thread. Callers set the next screen and return immediately,
+# they never wait for the I2C bus. If several screens are set before the worker gets to them, only the
+# newest one is rendered, the ones in between are dropped (coalesced).
+# Other LCD operations (initialization, clear, backlight) are queued as commands and run by the same thread in
+# the order they were called, before the next screen is rendered, so they never interrupt a screen update.
+# Queue depth, coalesced screens and the latency from request to rendered screen are recorded in the
+# metrics registry.
+import logging
+import threading
+import time
+from metrics import metrics
+
+
+class DisplayService(object):
+    """ Renders screens on an LCDFramebuffer from a worker thread """
+
+    def __init__(self, framebuffer, metrics=metrics):
+        self.framebuffer = framebuffer
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._screen = framebuffer.text()   # newest requested screen
+        self._pending = 0                   # screens requested since the last render
+        self._requested = None              # time of the oldest request that is not rendered yet
+        self._commands = []                 # (function, args) that the worker has not taken yet
+        self._queued = 0                    # commands that are not executed yet
+        self._running = True
+        self._thread = threading.Thread(target=self._renderLoop, name="display")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _request(self, rows):
+        with self._lock:
+            self._screen = rows
+            if self._pending == 0:
+                self._requested = time.time()
+            self._pending += 1
+            self.metrics.gauge('display.queue_depth', self._pending)
+            self._changed.notify()
+
+    def show(self, *lines):
+        """ Sets the next screen, rows without a line are blank """
+        lines = list(lines[:self.framebuffer.rows])
+        self._request(lines + [''] * (self.framebuffer.rows - len(lines)))
+
+    def write(self, row, text):
+        """ Replaces one row of the newest screen and keeps the others """
+        with self._lock:
+            rows = list(self._screen)
+        rows[row] = text
+        self._request(rows)
+
+    def call(self, function, *args):
+        """ Queues function(*args), e.g. lcd.begin or the backlight output, for the worker thread """
+        with self._lock:
+            self._commands.append((function, args))
+            self._queued += 1
+            self._changed.notify()
+
+    def clear(self):
+        """ Clears the LCD and shows a blank screen """
+        with self._lock:
+            self._commands.append((self.framebuffer.invalidate, ()))
+            self._queued += 1
+        self.show()
+
+    def flush(self, timeout=1):
+        """ Waits until the queued commands are executed and the newest screen is rendered, returns False on timeout """
+        deadline = time.time() + timeout
+        with self._lock:
+            while self._pending or self._queued:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+        return True
+
+    def stop(self):
+        self.flush()
+        with self._lock:
+            self._running = False
+            self._changed.notify_all()
+        self._thread.join(2)
+
+    def _renderLoop(self):
+        while True:
+            with self._lock:
+                while self._running and not self._pending and not self._commands:
+                    self._changed.wait()
+                if not self._running:
+                    return
+                commands, self._commands = self._commands, []
+                rows = self._screen
+                pending = self._pending
+                requested = self._requested
+            for function, args in commands:
+                try:
+                    function(*args)
+                except (IOError, OSError) as e:
+                    logging.error("LCD command failed: %s", e)
+            if pending:
+                try:
+                    with self.metrics.timer('display.render'):
+                        self.framebuffer.show(*rows)
+                except (IOError, OSError) as e:
+                    logging.error("LCD update failed: %s", e)
+            with self._lock:
+                # screens that were requested while rendering are rendered in the next round
+                self._queued -= len(commands)
+                self._pending -= pending
+                if self._pending:
+                    self._requested = time.time()
+                self.metrics.gauge('display.queue_depth', self._pending)
+                self._changed.notify_all()
+            if not pending:
+                continue
+            self.metrics.increment('display.renders')
+            self.metrics.increment('display.coalesced', pending - 1)
+            self.metrics.timing('display.render_latency', time.time() - requested)
@@ -0,0 +1,109 @@
+# Event-driven core of the smart doorbell
+# Button edges (GPIO thread), MQTT messages (AWSIoT SDK threads) and timers are posted as events into one
+# asyncio queue. A single task consumes them and drives the state machine of the current ring session,
+# so the ring state is only touched from the event loop thread and needs no locking.
+# Slow blocking steps (camera, upload, download, audio) run in the default executor and are awaited,
+# the loop keeps handling events in the meantime.
+import asyncio
+import logging
+import time
+
+# ring session states
+IDLE = 'idle'
+CAPTURING = 'capturing'
+UPLOADING = 'uploading'
+AWAITING_RESULT = 'awaiting result'
+PLAYING = 'playing'
+COOLDOWN = 'cooldown'
+
+# event types
+BUTTON = 'button'
+RESULT = 'result'
+GREETING = 'greeting'
+COMBINED_RESULT = 'combined result'
+TIMEOUT = 'timeout'
+
+
+class RingSession(object):
+    """ State of one ring, identified by its recognition id """
+
+    def __init__(self, recid):
+        self.recid = recid
+        self.started = time.time()
+        self.noFaceCounter = 0
+        self.result = None
+        self.greetingKey = None
+        self.greeting = None    # future of the greeting download
+        self.photo = None       # in-memory JPEG of this ring, never shared with another ring
+
+
+class DoorbellCore(object):
+    """ Event loop and state machine plumbing, the doorbell logic is implemented in handle() """
+
+    def __init__(self):
+        self.loop = None
+        self.queue = None
+        self.state = IDLE
+        self.session = None
+        self._timer = None
+
+    def post(self, event, payload=None):
+        """ Posts an event into the loop, safe to call from any thread """
+        if self.loop is None:
+            logging.warning("Event %s dropped, event loop is not running", event)
+            return
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (event, payload))
+
+    def run(self):
+        """ Runs the event loop until the process is interrupted """
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        await self.startup()
+        while True:
+            event, payload = await self.queue.get()
+            if event == TIMEOUT:
+                session, state = payload
+                # ignore timers of a state that was already left
+                if session is not self.session or state != self.state:
+                    continue
+            try:
+                await self.handle(event, payload)
+            except Exception:
+                logging.exception("Error while handling event '%s' in state '%s'", event, self.state)
+
+    def isCurrent(self, session, *states):
+        """ True if session is still the active ring (and in one of states, if given) """
+        return session is self.session and (not states or self.state in states)
+
+    def transition(self, state, timeout=None):
+        """ Enters state, cancels the timer of the previous state and arms a TIMEOUT event if timeout is given """
+        logging.info("Ring state: %s -> %s", self.state, state)
+        self.state = state
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if timeout is not None:
+            self._timer = self.loop.call_later(timeout, self.queue.put_nowait, (TIMEOUT, (self.session, state)))
+
+    def spawn(self, coroutine):
+        """ Runs a coroutine as task next to the event handling, errors are logged """
+        task = self.loop.create_task(coroutine)
+        task.add_done_callback(self._taskDone)
+        return task
+
+    def _taskDone(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Ring task failed in state '%s'", self.state, exc_info=task.exception())
+
+    def runBlocking(self, func, *args):
+        """ Runs a blocking call in the executor, returns an awaitable future """
+        return self.loop.run_in_executor(None, func, *args)
+
+    async def startup(self):
+        pass
+
+    async def handle(self, event, payload):
+        raise NotImplementedError
@@ -0,0 +1,38 @@
+# Lightweight on-device face detection for the smart doorbell
+# Uses the OpenCV Haar cascade on a downscaled grayscale copy of the frame, so frames without a face
+# are rejected and re-captured before anything leaves the device.
+# OpenCV is optional and only needed for the local face check:
+#   pip install opencv-python-headless
+import os
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+class FaceDetector(object):
+    """ Detects faces in RGB frames """
+
+    def __init__(self, scale=0.5, minNeighbors=5, minFaceRatio=0.1, cascadePath=None):
+        if cv2 is None:
+            raise ImportError("OpenCV (cv2) is required for the local face check")
+        if cascadePath is None:
+            cascadePath = os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
+        self.cascade = cv2.CascadeClassifier(cascadePath)
+        if self.cascade.empty():
+            raise IOError("Face cascade could not be loaded from " + cascadePath)
+        self.scale = scale
+        self.minNeighbors = minNeighbors
+        self.minFaceRatio = minFaceRatio
+
+    def detect(self, frame):
+        """ Returns the face boxes (x, y, width, height) in frame coordinates, largest face first """
+        small = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+        minSide = int(min(gray.shape) * self.minFaceRatio)
+        boxes = self.cascade.detectMultiScale(gray, scaleFactor=1.2, minNeighbors=self.minNeighbors,
+                                              minSize=(minSide, minSide))
+        faces = [tuple(int(value / self.scale) for value in box) for box in boxes]
+        faces.sort(key=lambda box: box[2] * box[3], reverse=True)
+        return faces
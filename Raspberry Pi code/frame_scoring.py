@@ -0,0 +1,77 @@
+# Frame quality scoring for burst captures
+# Every frame gets a focus score (variance of the Laplacian) and an exposure check (mean brightness, clipped pixels).
+# The scoring runs on a subsampled green channel with preallocated NumPy buffers to stay within a few
+# milliseconds per frame on a Raspberry Pi 3.
+#
+# Benchmark: python frame_scoring.py [width height]
+import sys
+import time
+from collections import namedtuple
+import numpy as np
+
+FrameScore = namedtuple('FrameScore', ['score', 'sharpness', 'brightness', 'clipped'])
+
+
+class FrameScorer(object):
+    """ Scores RGB frames of a fixed resolution, higher score = sharper and well exposed """
+
+    def __init__(self, width, height, step=2, minBrightness=40, maxBrightness=215, maxClipped=0.05, exposurePenalty=0.1):
+        self.step = step
+        self.minBrightness = minBrightness
+        self.maxBrightness = maxBrightness
+        self.maxClipped = maxClipped
+        self.exposurePenalty = exposurePenalty
+        rows = len(range(0, height, step))
+        cols = len(range(0, width, step))
+        self._gray = np.empty((rows, cols), dtype=np.float32)
+        self._laplacian = np.empty((rows - 2, cols - 2), dtype=np.float32)
+        self._center = np.empty((rows - 2, cols - 2), dtype=np.float32)
+
+    def score(self, frame):
+        """ Returns the FrameScore of an RGB frame (height x width x 3) """
+        gray = self._gray
+        # green channel is a good enough luminance approximation for focus and exposure
+        np.copyto(gray, frame[::self.step, ::self.step, 1], casting='unsafe')
+
+        # 4-neighbour Laplacian: up + down + left + right - 4 * center
+        laplacian = self._laplacian
+        np.add(gray[:-2, 1:-1], gray[2:, 1:-1], out=laplacian)
+        laplacian += gray[1:-1, :-2]
+        laplacian += gray[1:-1, 2:]
+        np.multiply(gray[1:-1, 1:-1], 4, out=self._center)
+        laplacian -= self._center
+        sharpness = float(laplacian.var())
+
+        brightness = float(gray.mean())
+        sample = gray[::2, ::2]
+        clipped = float(np.count_nonzero(sample >= 250) + np.count_nonzero(sample <= 5)) / sample.size
+
+        score = sharpness
+        if not self.minBrightness <= brightness <= self.maxBrightness or clipped > self.maxClipped:
+            score *= self.exposurePenalty
+        return FrameScore(score, sharpness, brightness, clipped)
+
+    def best(self, frames):
+        """ Returns (index, FrameScore) of the best frame in frames """
+        scores = [self.score(frame) for frame in frames]
+        index = max(range(len(scores)), key=lambda i: scores[i].score)
+        return index, scores[index]
+
+
+def benchmark(width, height, frames=8, rounds=20):
+    """ Prints the average scoring time per frame for the given resolution """
+    scorer = FrameScorer(width, height)
+    burst = np.random.randint(0, 256, size=(frames, height, width, 3), dtype=np.uint8)
+    scorer.best(burst)  # warm up
+    start = time.time()
+    for _ in range(rounds):
+        scorer.best(burst)
+    elapsed = (time.time() - start) / (rounds * frames)
+    print("Frame scoring at %dx%d: %.2f ms per frame" % (width, height, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    width, height = 800, 600
+    if len(sys.argv) == 3:
+        width, height = int(sys.argv[1]), int(sys.argv[2])
+    benchmark(width, height)
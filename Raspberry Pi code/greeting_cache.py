@@ -0,0 +1,129 @@
+# On-device cache of the greeting MP3s
+# Greetings are stored on disk, keyed by their file name (File_name from DynamoDB, e.g. greeting-<hash>.mp3).
+# The cache is bounded in size with LRU eviction. Entries validated within revalidateAfter seconds are
+# played straight from disk, older entries are revalidated with a conditional GET (ETag / Last-Modified),
+# so a repeat visitor only costs a small 304 response. If the revalidation fails (HTTP error or no network),
+# the cached file is played anyway.
+import json
+import logging
+import os
+import posixpath
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import unquote, urlparse
+import urllib3
+from metrics import metrics
+
+
+class GreetingCache(object):
+    """ Size bounded LRU cache of greeting files with HTTP revalidation """
+
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, directory, session, maxBytes=20 * 1024 * 1024, revalidateAfter=3600, metrics=metrics):
+        self.directory = directory
+        self.session = session
+        self.maxBytes = maxBytes
+        self.revalidateAfter = revalidateAfter
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> {'size', 'etag', 'lastModified', 'validated'}, oldest first
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load()
+
+    @staticmethod
+    def keyForUrl(url):
+        """ Returns the cache key (file name) of a presigned greeting URL (.../mp3/<File_name>?...) """
+        return posixpath.basename(unquote(urlparse(url).path))
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _load(self):
+        try:
+            with open(self.path(self.INDEX_FILE)) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return
+        for key, entry in entries:
+            if os.path.exists(self.path(key)):
+                self._entries[key] = entry
+
+    def _save(self):
+        temp = self.path(self.INDEX_FILE + '.tmp')
+        with open(temp, 'w') as f:
+            json.dump(list(self._entries.items()), f)
+        os.replace(temp, self.path(self.INDEX_FILE))
+
+    def _evict(self):
+        total = sum(entry['size'] for entry in self._entries.values())
+        while total > self.maxBytes and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            total -= entry['size']
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+            self.metrics.increment('greeting_cache.evictions')
+            logging.info("Greeting cache: evicted %s", key)
+
+    def _hit(self, key, entry):
+        self._entries.move_to_end(key)
+        self.metrics.increment('greeting_cache.hits')
+        self.metrics.increment('greeting_cache.bytes_saved', entry['size'])
+        return self.path(key)
+
+    def get(self, key, url):
+        """ Returns the local path of the greeting, downloads or revalidates it with url if needed """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry['validated'] < self.revalidateAfter:
+                return self._hit(key, entry)
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('lastModified'):
+                headers['If-Modified-Since'] = entry['lastModified']
+        try:
+            response = self.session.fetch(url, headers)
+        except (urllib3.exceptions.HTTPError, OSError) as e:
+            if entry is None:
+                raise
+            # offline: serve the stale greeting, it is revalidated again with the next ring
+            logging.warning("Greeting revalidation failed (%s), using cached file", e)
+            with self._lock:
+                return self._hit(key, entry)
+
+        with self._lock:
+            if entry is not None and (response.status == 304 or response.status >= 400):
+                if response.status >= 400:
+                    # serve the stale greeting rather than nothing
+                    logging.warning("Greeting revalidation failed with HTTP status %d, using cached file", response.status)
+                entry['validated'] = time.time()
+                self.metrics.increment('greeting_cache.revalidations')
+                self._save()
+                return self._hit(key, entry)
+            if response.status >= 400:
+                raise IOError("Greeting download failed with HTTP status %d" % response.status)
+
+            temp = self.path(key + '.tmp')
+            with open(temp, 'wb') as f:
+                f.write(response.data)
+            os.replace(temp, self.path(key))
+            self._entries[key] = {'size': len(response.data), 'etag': response.headers.get('ETag'),
+                                  'lastModified': response.headers.get('Last-Modified'), 'validated': time.time()}
+            self._entries.move_to_end(key)
+            self.metrics.increment('greeting_cache.misses')
+            self._evict()
+            self._save()
+            return self.path(key)
+
+    def stats(self):
+        """ Returns hits, misses and bytes saved so far """
+        snapshot = self.metrics.snapshot()
+        return {'hits': snapshot.get('greeting_cache.hits', 0), 'misses': snapshot.get('greeting_cache.misses', 0),
+                'bytes_saved': snapshot.get('greeting_cache.bytes_saved', 0)}
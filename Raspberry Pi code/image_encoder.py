@@ -0,0 +1,75 @@
+# Encoding stage for the recognition photo
+# The frame is cropped to the detected face plus a margin, downsized to a maximum size and encoded with the
+# highest JPEG quality that fits into the byte budget. Rekognition only needs the face, so this cuts the
+# upload size on slow uplinks. Timings and sizes are recorded in the metrics registry.
+import io
+import time
+from PIL import Image
+from metrics import metrics
+
+
+class ImageEncoder(object):
+    """ Crops, downsizes and encodes RGB frames as JPEG within a byte budget """
+
+    def __init__(self, margin=0.5, maxSize=640, byteBudget=60000, minQuality=40, maxQuality=90, metrics=metrics):
+        self.margin = margin
+        self.maxSize = maxSize
+        self.byteBudget = byteBudget
+        self.minQuality = minQuality
+        self.maxQuality = maxQuality
+        self.metrics = metrics
+        self._scratch = io.BytesIO()
+
+    def cropBox(self, face, width, height):
+        """ Returns (left, top, right, bottom) of the face box (x, y, w, h) plus margin, clipped to the frame """
+        x, y, w, h = face
+        dx = int(w * self.margin)
+        dy = int(h * self.margin)
+        return (max(0, x - dx), max(0, y - dy), min(width, x + w + dx), min(height, y + h + dy))
+
+    def _encode(self, image, quality):
+        self._scratch.seek(0)
+        self._scratch.truncate()
+        image.save(self._scratch, 'JPEG', quality=quality)
+        return self._scratch.tell()
+
+    def encode(self, frame, output, face=None):
+        """ Writes the JPEG for frame to output, face is an optional box (x, y, w, h) to crop to
+
+        Returns a dict with the resulting bytes, JPEG quality and crop/encode times in ms
+        """
+        start = time.time()
+        if face is not None:
+            left, top, right, bottom = self.cropBox(face, frame.shape[1], frame.shape[0])
+            frame = frame[top:bottom, left:right]
+        image = Image.fromarray(frame)
+        if max(image.size) > self.maxSize:
+            image.thumbnail((self.maxSize, self.maxSize), Image.BILINEAR)
+        cropped = time.time()
+
+        # binary search for the highest quality within the byte budget
+        low, high = self.minQuality, self.maxQuality
+        quality = low
+        size = self._encode(image, high)
+        if size <= self.byteBudget:
+            quality = high
+        else:
+            while low < high - 1:
+                middle = (low + high) // 2
+                if self._encode(image, middle) <= self.byteBudget:
+                    low = middle
+                else:
+                    high = middle
+            quality = low
+            size = self._encode(image, quality)
+        output.write(self._scratch.getbuffer()[:size])
+        encoded = time.time()
+
+        result = {'bytes': size, 'quality': quality, 'width': image.size[0], 'height': image.size[1],
+                  'crop_ms': (cropped - start) * 1000, 'encode_ms': (encoded - cropped) * 1000}
+        self.metrics.timing('encoder.crop', cropped - start)
+        self.metrics.timing('encoder.encode', encoded - cropped)
+        self.metrics.gauge('encoder.bytes', size)
+        self.metrics.gauge('encoder.quality', quality)
+        self.metrics.increment('encoder.bytes_total', size)
+        return result
@@ -0,0 +1,86 @@
+# Shadow framebuffer for the 16x2 LCD
+# The framebuffer keeps the text that is on every cell of the display. A new screen is written as the
+# differences to the current one: for every run of changed cells one setCursor and the changed characters.
+# The display is never cleared (a clear takes more than 1.5 ms and rewrites every cell), so a countdown
+# only rewrites the digit that changes. Bytes saved compared to clear + full rewrite and the I2C write
+# transactions of the updates (counted by the PCF8574 chip of the LCD, if it has one) are recorded in the
+# metrics registry.
+from metrics import metrics
+
+
+class LCDFramebuffer(object):
+    """ Diff based updates of an Adafruit_CharLCD compatible display """
+
+    def __init__(self, lcd, cols=16, rows=2, maxGap=2, metrics=metrics):
+        self.lcd = lcd
+        self.cols = cols
+        self.rows = rows
+        self.maxGap = maxGap    # unchanged cells between two changes that are rewritten instead of a new setCursor
+        self.metrics = metrics
+        self._screen = [' ' * cols for row in range(rows)]     # the display is blank after initialization
+
+    def _fit(self, text):
+        return (text or '')[:self.cols].ljust(self.cols)
+
+    def _runs(self, current, target):
+        """ Returns (column, text) of the changed parts of a row """
+        runs = []
+        start = end = None
+        for col in range(self.cols):
+            if current[col] == target[col]:
+                continue
+            if start is not None and col - end - 1 <= self.maxGap:
+                end = col
+                continue
+            if start is not None:
+                runs.append((start, target[start:end + 1]))
+            start = end = col
+        if start is not None:
+            runs.append((start, target[start:end + 1]))
+        return runs
+
+    def _busTransactions(self):
+        """ Returns the write transactions of the PCF8574 chip of the LCD so far, None without one """
+        return getattr(getattr(self.lcd, 'chip', None), 'transactions', None)
+
+    def _update(self, target, baselineBytes):
+        written = 0
+        before = self._busTransactions()
+        for row in range(self.rows):
+            for col, text in self._runs(self._screen[row], target[row]):
+                self.lcd.setCursor(col, row)
+                self.lcd.message(text)
+                written += 1 + len(text)
+            self._screen[row] = target[row]
+        self.metrics.increment('lcd.updates')
+        self.metrics.increment('lcd.bytes_written', written)
+        self.metrics.increment('lcd.bytes_saved', max(0, baselineBytes - written))
+        if before is not None:
+            # the chip counter also includes backlight and LED writes of other threads during the update
+            self.metrics.increment('lcd.transactions', self._busTransactions() - before)
+
+    def show(self, *lines):
+        """ Shows lines on the display, rows without a line are blank """
+        lines = list(lines[:self.rows])
+        target = [self._fit(line) for line in lines] + [' ' * self.cols] * (self.rows - len(lines))
+        # clear, message of the first line, setCursor and message for every further line
+        baselineBytes = 1 + sum(len(line or '') for line in lines) + len(lines) - 1
+        self._update(target, baselineBytes)
+
+    def write(self, row, text):
+        """ Replaces one row and keeps the others """
+        target = list(self._screen)
+        target[row] = self._fit(text)
+        self._update(target, 1 + len(text))
+
+    def clear(self):
+        self.show()
+
+    def invalidate(self):
+        """ Clears the display, e.g. after the LCD was written to without the framebuffer """
+        self.lcd.clear()
+        self._screen = [' ' * self.cols for row in range(self.rows)]
+
+    def text(self):
+        """ Returns the rows that are on the display """
+        return list(self._screen)
@@ -0,0 +1,60 @@
+# In-process metrics for the smart doorbell
+# Counters, gauges and timings are kept in memory, shared by all modules through the "metrics" registry
+# and can be printed with report() to tune the doorbell
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics(object):
+    """ Thread-safe registry of counters, gauges and timings """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timings = {}
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def timing(self, name, seconds):
+        """ Records a duration, keeps count, total, last and max value """
+        with self._lock:
+            count, total, last, maximum = self._timings.get(name, (0, 0.0, 0.0, 0.0))
+            self._timings[name] = (count + 1, total + seconds, seconds, max(maximum, seconds))
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timing(name, time.time() - start)
+
+    def snapshot(self):
+        """ Returns a copy of all values as dict """
+        with self._lock:
+            result = dict(self._counters)
+            result.update(self._gauges)
+            for name, (count, total, last, maximum) in self._timings.items():
+                result[name] = {'count': count, 'avg_ms': total / count * 1000, 'last_ms': last * 1000, 'max_ms': maximum * 1000}
+            return result
+
+    def report(self, logger=logging):
+        for name, value in sorted(self.snapshot().items()):
+            if isinstance(value, dict):
+                logger.info("%s: count=%d avg=%.1fms last=%.1fms max=%.1fms", name,
+                            value['count'], value['avg_ms'], value['last_ms'], value['max_ms'])
+            else:
+                logger.info("%s: %s", name, value)
+
+
+# shared registry
+metrics = Metrics()
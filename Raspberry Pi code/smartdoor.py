@@ -5,26 +5,36 @@ from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
 import sys
 import logging
 import time
+import asyncio
 import getopt
 from datetime import datetime
 import picamera
 import os
-import boto3
+import io
+import base64
 import json
 import random
 import RPi.GPIO as GPIO
-import urllib.request, urllib.error, urllib.parse
-import pygame
 from PCF8574 import PCF8574_GPIO
-from Adafruit_LCD1602 import Adafruit_CharLCD
+from Adafruit_LCD1602 import PCF8574_CharLCD
+from lcd_framebuffer import LCDFramebuffer
+from display_service import DisplayService
+from camera_pipeline import CameraPipeline, CAPTURE_MODES
+from aws_session import DoorbellSession
+from face_detector import FaceDetector
+from image_encoder import ImageEncoder
+from greeting_cache import GreetingCache
+from audio_engine import AudioEngine
+from metrics import metrics
+from doorbell_core import DoorbellCore, RingSession, IDLE, CAPTURING, UPLOADING, AWAITING_RESULT, PLAYING, COOLDOWN, BUTTON, RESULT, GREETING, COMBINED_RESULT, TIMEOUT
 import serial
 import time
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 
 # Usage
 usageInfo = """Usage:
 Use certificate based mutual authentication:
-python smartdoor.py -e <endpoint> -r <rootCAFilePath> -c <certFilePath> -k <privateKeyFilePath> -a <APIAccessKey> -s <APISecret> -b <Bucketname>
+python smartdoor.py -e <endpoint> -r <rootCAFilePath> -c <certFilePath> -k <privateKeyFilePath> -a <APIAccessKey> -s <APISecret> -b <Bucketname> [-m <still|ring>] [-n <burstCount>] [-f] [-t <combined|legacy>] [-i <s3|direct>] [-g <AWSRegion>] [-l <MatchFunctionName>]
 Type "python smartdoor.py -h" for available options.
 """
 # Help info
@@ -42,6 +52,23 @@ helpInfo = """-e, --endpoint
         AWS User Access Secret
 -b, --bucket
         S3 Bucketname that was provisioned for FaceRecognition Service
+-m, --captureMode
+        Camera capture mode: "still" (default, photo is taken on the still port after the countdown)
+        or "ring" (continuous video port capture, the latest frame is used)
+-n, --burst
+        Number of frames taken per photo, the sharpest and best exposed frame is uploaded (default 1 = no burst)
+-f, --faceCheck
+        Check locally for a face before uploading, frames without a face are taken again (requires OpenCV)
+-t, --resultMode
+        IoT result messages: "combined" (default, one message on doorbell/result)
+        or "legacy" (separate messages on rekognition/result and polly/result)
+-i, --ingest
+        How the photo is submitted: "s3" (default, upload to S3 which triggers the match function)
+        or "direct" (the match function is invoked with the image bytes, S3 is used for photos that are too large)
+-g, --region
+        AWS Region of the Face Rekognition Service, if not specified US-EAST-1 will be taken
+-l, --matchFunction
+        Name of the match Lambda function for the direct ingest (default FaceRecognitionStack-LambdaMatchFacesRekognitionService)
 -h, --help
 	Help information
 """
@@ -54,9 +81,16 @@ privateKeyPath = ""
 access_key_id =""
 secret_access_key=""
 bucket_name=""
+capture_mode="still"
+burst_count=1
+local_face_check=False
+result_mode="combined"
+ingest_mode="s3"
+region="us-east-1"
+match_function="FaceRecognitionStack-LambdaMatchFacesRekognitionService"
 
 try:
-	opts, args = getopt.getopt(sys.argv[1:], "hwe:k:c:r:a:s:b:", ["help", "endpoint=", "key=","cert=","rootCA=","accessKey=","secret=","bucket="])
+	opts, args = getopt.getopt(sys.argv[1:], "hwe:k:c:r:a:s:b:m:n:ft:i:g:l:", ["help", "endpoint=", "key=","cert=","rootCA=","accessKey=","secret=","bucket=","captureMode=","burst=","faceCheck","resultMode=","ingest=","region=","matchFunction="])
 	if len(opts) == 0:
 		raise getopt.GetoptError("No input parameters!")
 	for opt, arg in opts:
@@ -77,7 +111,21 @@ try:
 			secret_access_key = arg
 		if opt in ("-b", "--bucket"):
 			bucket_name = arg
-except getopt.GetoptError:
+		if opt in ("-m", "--captureMode"):
+			capture_mode = arg
+		if opt in ("-n", "--burst"):
+			burst_count = int(arg)
+		if opt in ("-f", "--faceCheck"):
+			local_face_check = True
+		if opt in ("-t", "--resultMode"):
+			result_mode = arg
+		if opt in ("-i", "--ingest"):
+			ingest_mode = arg
+		if opt in ("-g", "--region"):
+			region = arg
+		if opt in ("-l", "--matchFunction"):
+			match_function = arg
+except (getopt.GetoptError, ValueError):
 	print(usageInfo)
 	exit(1)
 
@@ -104,6 +152,15 @@ if not secret_access_key:
 if not bucket_name:
     print("Missing '-b' or '--bucket'")
     missingConfiguration = True
+if capture_mode not in CAPTURE_MODES:
+    print("Invalid '-m' or '--captureMode', use one of: " + ", ".join(CAPTURE_MODES))
+    missingConfiguration = True
+if result_mode not in ("combined", "legacy"):
+    print("Invalid '-t' or '--resultMode', use one of: combined, legacy")
+    missingConfiguration = True
+if ingest_mode not in ("s3", "direct"):
+    print("Invalid '-i' or '--ingest', use one of: s3, direct")
+    missingConfiguration = True
 if missingConfiguration:
 	exit(2)
 
@@ -112,14 +169,33 @@ if missingConfiguration:
 image_width = 800
 image_height = 600
 file_extension = '.jpg'
+ring_size = 4           # number of frames kept in the ring buffer (ring capture mode)
+ring_framerate = 10     # frames per second captured on the video port (ring capture mode)
+face_check_retries = 3  # photos taken before giving up if the local face check finds no face
+crop_margin = 0.5       # margin around the detected face (relative to the face size) that is uploaded
+upload_max_size = 640   # maximum width/height of the uploaded photo
+upload_byte_budget = 60000  # the JPEG quality is chosen so that the uploaded photo fits into this size
+direct_max_bytes = 180000   # larger photos are uploaded to S3 in the direct ingest mode (async Lambda payload limit 256 KB)
+
+# AWS connections are refreshed in this interval (seconds) so they are still open when the button is pushed
+keepalive_interval = 15
+
+# Greeting MP3s are cached on the SD card, so repeat visitors are greeted without a download
+greeting_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'greetings')
+greeting_cache_size = 20 * 1024 * 1024  # bytes, least recently used greetings are evicted
+greeting_revalidate_after = 3600        # seconds after which a cached greeting is revalidated (ETag/Last-Modified)
+default_greeting = 'No_face_match.mp3'  # greeting for unknown persons, decoded at startup
+greeting_sounds = 8                     # number of decoded greetings kept in memory
 
 # Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("AWSIoTPythonSDK.core")
 logger.setLevel(logging.DEBUG)
 streamHandler = logging.StreamHandler()
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 streamHandler.setFormatter(formatter)
 logger.addHandler(streamHandler)
+logger.propagate = False    # has its own handler, the messages are not logged twice by the root logger
 
 # Init AWSIoTMQTTClient
 myAWSIoTMQTTClient = None
@@ -135,10 +211,29 @@ myAWSIoTMQTTClient.configureDrainingFrequency(2)  # Draining: 2 Hz
 myAWSIoTMQTTClient.configureConnectDisconnectTimeout(10)  # 10 sec
 myAWSIoTMQTTClient.configureMQTTOperationTimeout(5)  # 5 sec
 
+# Long-lived S3 client and connection pool, shared by the photo upload and the greeting download
+awsSession = DoorbellSession(access_key_id, secret_access_key, bucket_name, region=region, keepAliveInterval=keepalive_interval,
+                             matchFunction=match_function if ingest_mode == "direct" else None)
+greetingCache = GreetingCache(greeting_cache_dir, awsSession, maxBytes=greeting_cache_size, revalidateAfter=greeting_revalidate_after)
+
+# Audio mixer is initialized once, greetings are played from decoded sounds in memory
+audioEngine = AudioEngine(maxSounds=greeting_sounds)
+
 # camera setup
 camera = picamera.PiCamera()
 camera.resolution = (image_width, image_height)
 camera.awb_mode = 'auto'
+imageEncoder = ImageEncoder(margin=crop_margin, maxSize=upload_max_size, byteBudget=upload_byte_budget)
+cameraPipeline = CameraPipeline(camera, mode=capture_mode, ringSize=ring_size, ringFramerate=ring_framerate, burstCount=burst_count, encoder=imageEncoder)
+
+# Local face check, rejects photos without a face before they are uploaded
+faceDetector = None
+if local_face_check:
+    try:
+        faceDetector = FaceDetector()
+    except (ImportError, IOError) as e:
+        print("Local face check not available: " + str(e))
+        exit(2)
 
 buzzerPin = 11    # define the buzzerPin
 buttonPin = 12    # define the buttonPin
@@ -158,10 +253,14 @@ except:
 		print ('I2C Address Error !')
 		exit(1)
 # Create LCD, passing in MCP GPIO adapter.
-lcd = Adafruit_CharLCD(pin_rs=0, pin_e=2, pins_db=[4,5,6,7], GPIO=mcp)
+lcd = PCF8574_CharLCD(pin_rs=0, pin_e=2, pins_db=[4,5,6,7], GPIO=mcp)
+# Screen updates only write the cells that change, a worker thread renders them
+display = DisplayService(LCDFramebuffer(lcd, 16, 2))
 
-# Counter for retries if no face is detected
-noFaceCounter = 0
+# Ring session timing (seconds)
+result_timeout = 30     # the ring is cancelled if no result arrives within this time after the upload
+greeting_timeout = 15   # the ring is finished if no greeting arrives within this time after the result
+cooldown_time = 1       # pause after the greeting started before the next ring is accepted
 
 #--------------------------------- GPIO Functions --------------------------------------------
 def setup():
@@ -173,9 +272,13 @@ def setup():
     GPIO.setup(ylwLedPin, GPIO.OUT)
     
 def destroy():
+    cameraPipeline.stop()
+    awsSession.stop()
+    audioEngine.stop()
+    display.clear()
+    display.stop()
     GPIO.output(buzzerPin, GPIO.LOW)     # buzzer off
     GPIO.cleanup()                     # Release resource
-    lcd.clear()
 
 #--------------------------------- Helper Functions --------------------------------------------
 def randomDigits(digits):
@@ -183,219 +286,285 @@ def randomDigits(digits):
     upper = 10**digits - 1
     return random.randint(lower, upper)
         
-def uploadToS3(file_name):
+def takePhoto(photo):
+    ''' Captures the photo straight into the in-memory buffer of the ring, nothing is stored on the SD card
+    Every ring has its own buffer, so an upload of a ring that timed out is not overwritten by the next ring
+    With the local face check, False is returned if there is no face on the photo
+    '''
+    photo.seek(0)
+    photo.truncate()
+    if faceDetector is None:
+        cameraPipeline.capture(photo)
+        photo.seek(0)
+        return True
     
-    filepath = file_name + file_extension
-    camera.capture(filepath)
+    frame = cameraPipeline.captureFrame()
+    faces = faceDetector.detect(frame)
+    if not faces:
+        return False
+    # upload only the largest face plus margin
+    cameraPipeline.encode(frame, photo, faces[0])
+    photo.seek(0)
+    return True
+        
+def uploadToS3(file_name, photo):
+    
+    # the recid is carried in the object key, the match function reads it from the S3 event
+    key = "matches/" + file_name + file_extension
+    
+    if cameraPipeline.lastEncoding is not None:
+        print("Photo encoded: %(width)dx%(height)d, %(bytes)d bytes, quality %(quality)d, crop %(crop_ms).1f ms, encode %(encode_ms).1f ms" % cameraPipeline.lastEncoding)
+    
+    # stream the upload from the in-memory photo
     try:
-        client = boto3.client('s3',aws_access_key_id=access_key_id,aws_secret_access_key=secret_access_key)
-        response = client.upload_file(filepath, bucket_name, "matches/" + filepath,ExtraArgs={'Metadata': {'cache-control': 'max-age=60','recid': file_name}})
-    except ClientError as e:
+        awsSession.s3.upload_fileobj(photo, bucket_name, key, ExtraArgs={'ContentType': 'image/jpeg', 'Metadata': {'cache-control': 'max-age=60'}})
+    except (BotoCoreError, ClientError) as e:
         logging.error(e)
         return False
     return True
 
-    if os.path.exists(filepath):
-        os.remove(filepath)
-        
+def preloadDefaultGreeting():
+    ''' Fetches the greeting for unknown persons into the cache and decodes it '''
+    url = awsSession.s3.generate_presigned_url('get_object', Params={'Bucket': bucket_name, 'Key': 'mp3/' + default_greeting}, ExpiresIn=600)
+    audioEngine.preload(default_greeting, greetingCache.get(default_greeting, url))
+
+def submitPhoto(recid, photo):
+    ''' Submits the photo for the face match, directly to the match function or as upload to S3 '''
+    size = len(photo.getbuffer())
+    if ingest_mode == "direct" and size <= direct_max_bytes:
+        payload = json.dumps({'Recid': recid, 'Image': base64.b64encode(photo.getbuffer()).decode('ascii')})
+        try:
+            awsSession.invokeMatch(payload)
+            return True
+        except (BotoCoreError, ClientError) as e:
+            logging.error(e)
+            print("Direct submission failed, falling back to S3 upload")
+    return uploadToS3(recid, photo)
+
+def playGreeting(key, filename):
+    # returns immediately, the audio engine plays on its own thread
+    print ("play")
+    audioEngine.play(key, filename)
+    
+    stats = greetingCache.stats()
+    print("Greeting cache: %(hits)d hits, %(misses)d misses, %(bytes_saved)d bytes saved" % stats)
+
+def reportMetrics():
+    # logged at the end of every ring: timings of photo, upload, display and playback
+    logging.info("Metrics after the ring:")
+    metrics.report()
+
+def showMessage(line1, line2=None):
+    display.show(line1, line2)
+
+def setLeds(yellow, red, green):
+    GPIO.output(ylwLedPin, yellow)
+    GPIO.output(redLedPin, red)
+    GPIO.output(grnLedPin, green)
+
 #--------------------------------- IOT Callback Functions --------------------------------------------
+# The callbacks run in the threads of the AWSIoT SDK, they only hand the message over to the event loop
 def pollyCallback(client, userdata, message):
-
-    print("Received a new message: ")
-    data = json.loads(message.payload.decode('utf-8'))
-    try:
-        # extract URL + RecID
-        s3url = data['s3url']
-        print(("Received s3url: " + str(s3url)))
-        
-        rcvid = data['recid']
-        print(("Received RecID: " + str(rcvid)))
-        
-        # compare RecID to local one and play message     
-        if str(recid) == str(rcvid):       
-            print("Download S3 URL")
-            filedata = urllib.request.urlopen(s3url)
-            datatowrite = filedata.read()
-            
-            print("write Data to local File")
-            filename = rcvid + ".mp3"
-            with open(filename, 'wb') as f:
-                f.write(datatowrite)
+    print("Received a new message on " + message.topic)
+    smartDoor.post(GREETING, message.payload)
         
-            pygame.mixer.pre_init(44100, -16, 2, 2048) # setup mixer to avoid sound lag
-            pygame.init()
-            pygame.mixer.init()
-            pygame.mixer.music.load(filename)
-            print ("play")
-            pygame.mixer.music.play()
-            
-            # Delete MP3 File
-            if os.path.exists(filename):
-                os.remove(filename)
+def photoVerificationCallback(client, userdata, message):
+    print("Received a new message on " + message.topic)
+    smartDoor.post(RESULT, message.payload)
+
+def resultCallback(client, userdata, message):
+    print("Received a new message on " + message.topic)
+    smartDoor.post(COMBINED_RESULT, message.payload)
+
+#--------------------------------- Ring State Machine --------------------------------------------
+class SmartDoor(DoorbellCore):
+    ''' Ring session state machine: idle -> capturing -> uploading -> awaiting result -> playing -> cooldown -> idle
+    All methods run in the event loop thread, blocking steps are awaited in the executor
+    '''
+
+    async def startup(self):
+        try:
+            await self.runBlocking(preloadDefaultGreeting)
+        except Exception as e:
+            logging.warning("Default greeting could not be preloaded: %s", e)
+
+    async def handle(self, event, payload):
+        if event == BUTTON:
+            if self.state != IDLE:
+                print("Button pushed")
+                return
+            # create random recognition id
+            self.session = RingSession(str(randomDigits(15)))
+            self.transition(CAPTURING)
+            self.spawn(self.ringSequence(self.session))
+        elif event == RESULT:
+            self.onResult(json.loads(payload.decode('utf-8')))
+        elif event == GREETING:
+            data = json.loads(payload.decode('utf-8'))
+            self.onGreeting(data.get('recid'), data['s3url'])
+        elif event == COMBINED_RESULT:
+            # one message with result and greeting URL (Version 2)
+            data = json.loads(payload.decode('utf-8'))
+            self.onResult(data)
+            if data.get('S3url'):
+                self.onGreeting(data.get('Recid'), data['S3url'], data.get('File_name'))
+        elif event == TIMEOUT:
+            self.onTimeout()
+
+    async def buzz(self):
+        print('buzzer on ...')
+        GPIO.output(buzzerPin,GPIO.HIGH)
+        await asyncio.sleep(2)
+        GPIO.output(buzzerPin,GPIO.LOW)
 
+    async def ringSequence(self, session):
+        setLeds(GPIO.LOW, GPIO.LOW, GPIO.LOW)
+        showMessage('Let`s go!')
+        # the buzzer rings while the messages are shown
+        self.spawn(self.buzz())
+        await asyncio.sleep(0.5)
+        
+        # activate yellow LED
+        GPIO.output(ylwLedPin,GPIO.HIGH)
+        showMessage('Let`s check who', 'you are...')
+        await asyncio.sleep(1.5)
+        await self.captureAndUpload(session)
+
+    async def captureAndUpload(self, session):
+        session.photo = io.BytesIO()
+        for attempt in range(face_check_retries):
+            for x in range(3, 0,-1):
+                showMessage("Photo in %d" %x)
+                await asyncio.sleep(0.5)
+            display.write(1, 'Cheese! :-)')
+            print("taking photo....")
+            if await self.runBlocking(takePhoto, session.photo):
+                break
+            print("No face in photo, lets try again")
+            showMessage('No face detected', 'Look at camera!')
+            await asyncio.sleep(0.5)
         else:
-            print("RecID does not match")
+            # nothing is uploaded, reset the door for the next try
+            print("No face found locally, photo is not uploaded")
+            self.reset('No face found.', 'Ring again!')
             return
         
-        global locked
-        locked = 0
-        
-    except Exception as e:
-        print(e)
-        raise e
-        
-def photoVerificationCallback(client, userdata, message):
-    
-    global noFaceCounter
-
-    print("Received a new message: ")
-    data = json.loads(message.payload.decode('utf-8'))
-    print(data)
-    try:
+        if not self.isCurrent(session, CAPTURING):
+            return
+        self.transition(UPLOADING, result_timeout)
+        if not await self.runBlocking(submitPhoto, session.recid, session.photo):
+            # the ring may have timed out during a slow upload, a newer ring is not reset
+            if self.isCurrent(session, UPLOADING):
+                self.reset('Upload failed.', 'Ring again!')
+            return
+        if self.isCurrent(session, UPLOADING):
+            self.transition(AWAITING_RESULT, result_timeout)
+
+    def onResult(self, data):
+        print(data)
+        session = self.session
+        rcvid = data.get('Recid')
+        # compare RecID to local one
+        if session is None or str(session.recid) != str(rcvid) or self.state not in (UPLOADING, AWAITING_RESULT):
+            print("RecID does not match")
+            return
         match = data['Match_found']
-        print(("Received match: " + str(match)))
         fullname = data['Full_name']
+        print(("Received match: " + str(match)))
         print(("Received Name: " + str(fullname)))
-        rcvid = data['Recid']
-        print(("Received RecID: " + str(rcvid)))
-        
-        # compare RecID to local one and play message     
-        if str(recid) == str(rcvid):    
-            if match == "false":
-                
-                # reset noFaceCounter
-                noFaceCounter = 0
-
-                print("No Match found!")
-                lcd.clear()
-                #lcd.setCursor(0,0)  # set cursor position
-                lcd.message( 'I don`t know' )
-                lcd.setCursor(0,1)
-                lcd.message( 'you. Go away!' )
-                #time.sleep (5)
-
-                # change LED Light from yellow to red
-                GPIO.output(ylwLedPin,GPIO.LOW) # deactivate yellow LED
-                GPIO.output(redLedPin,GPIO.HIGH) # activate red LED
-                GPIO.output(grnLedPin,GPIO.LOW) # deactivate green LED
-                
-                # Reset locked variable
-                global locked
-                locked = 0
-
-            elif match == "No face":
-                if noFaceCounter < 3:
-                    noFaceCounter = noFaceCounter + 1
-                    print("No Face in image decteted, lets try again")
-                    lcd.clear()
-                    lcd.message('No face detetect')
-                    lcd.setCursor(0,1)
-                    lcd.message('in image.')
-                    time.sleep(2)
-
-                    for x in range(3, 0,-1):
-                        lcd.clear()
-                        lcd.message("Photo in %d" %x)
-                        time.sleep(0.5)
-
-                    lcd.setCursor(0,1)
-                    lcd.message('Cheese! :-)')
-                    print("taking photo....")
-                    uploadToS3(recid)
-                else:
-                    noFaceCounter = 0
-                    locked = 0
-
-                    # Reset LEDs and LCD Display
-                    initHardware()
-                    return
+        session.result = data
+
+        if match == "No face":
+            if session.noFaceCounter < 3:
+                session.noFaceCounter = session.noFaceCounter + 1
+                print("No Face in image decteted, lets try again")
+                self.transition(CAPTURING)
+                self.spawn(self.retrySequence(session))
             else:
-                print("Match found!")
-
-                # reset noFaceCounter
-                noFaceCounter = 0
-
-                lcd.clear()
-                lcd.message( fullname )# 
-                lcd.setCursor(0,1) 
-                lcd.message( 'Come in!')# 
+                self.reset()
+            return
 
-                # change LED Light from yellow to green
-                GPIO.output(ylwLedPin,GPIO.LOW) # deactivate yellow LED
-                GPIO.output(grnLedPin,GPIO.HIGH) # activate green LED
-                GPIO.output(redLedPin,GPIO.LOW) # deactivate red LED
-                
+        if match == "false":
+            print("No Match found!")
+            showMessage('I don`t know', 'you. Go away!')
+            # change LED Light from yellow to red
+            setLeds(GPIO.LOW, GPIO.HIGH, GPIO.LOW)
         else:
+            print("Match found!")
+            showMessage(fullname, 'Come in!')
+            # change LED Light from yellow to green
+            setLeds(GPIO.LOW, GPIO.LOW, GPIO.HIGH)
+
+        self.transition(PLAYING, greeting_timeout)
+        if session.greeting is not None:
+            self.spawn(self.greetingSequence(session))
+
+    async def retrySequence(self, session):
+        showMessage('No face detetect', 'in image.')
+        await asyncio.sleep(2)
+        if self.isCurrent(session, CAPTURING):
+            await self.captureAndUpload(session)
+
+    def onGreeting(self, rcvid, s3url, fileName=None):
+        session = self.session
+        if session is None or str(session.recid) != str(rcvid) or session.greeting is not None:
             print("RecID does not match")
             return
-    except:
-        pass
-    print("Finished processing event.")
+        print(("Received s3url: " + str(s3url)))
+        # start the download (or cache lookup) right away, even if the result message is not there yet
+        session.greetingKey = fileName or GreetingCache.keyForUrl(s3url)
+        session.greeting = self.runBlocking(greetingCache.get, session.greetingKey, s3url)
+        if self.state == PLAYING:
+            self.spawn(self.greetingSequence(session))
+
+    async def greetingSequence(self, session):
+        try:
+            filename = await session.greeting
+            if self.isCurrent(session, PLAYING):
+                playGreeting(session.greetingKey, filename)
+                # the cooldown starts when the greeting is audible, its playback_start is then in the ring's metrics
+                await self.runBlocking(audioEngine.waitStarted)
+        finally:
+            if self.isCurrent(session, PLAYING):
+                self.transition(COOLDOWN, cooldown_time)
+
+    def onTimeout(self):
+        if self.state in (UPLOADING, AWAITING_RESULT):
+            print("No result received")
+            self.reset('No answer.', 'Ring again!')
+        else:
+            # no greeting or cooldown is over, the result stays on the display
+            self.transition(IDLE)
+            self.session = None
+            reportMetrics()
+
+    def reset(self, line1=None, line2=None):
+        ''' Ends the ring session, resets LEDs and LCD display '''
+        self.transition(IDLE)
+        self.session = None
+        reportMetrics()
+        setLeds(GPIO.LOW, GPIO.LOW, GPIO.LOW)
+        # the display is not cleared, the framebuffer blanks the cells of the last screen
+        if line1 is not None:
+            showMessage(line1, line2)
+        else:
+            display.show()
+
+smartDoor = SmartDoor()
 
 #--------------------------------- Main Loop --------------------------------------------
 def buttonEvent(channel):
-    
-    global locked
-    
-    if locked == 0: 
-        
-        locked = 1
-        
-        GPIO.output(ylwLedPin,GPIO.LOW) # deactivate yellow LED
-        GPIO.output(grnLedPin,GPIO.LOW) # deactivate green LED
-        GPIO.output(redLedPin,GPIO.LOW) # deactivate red LED
-        
-        lcd.clear()
-        lcd.message('Let`s go!')
-
-        # Buzzer on
-        print('buzzer on ...')
-        GPIO.output(buzzerPin,GPIO.HIGH)
-        time.sleep(2)
-        # Buzzer off
-        GPIO.output(buzzerPin,GPIO.LOW)
-        
-        lcd.clear() # clear LCD
-        
-        # create random recognition id
-        global recid 
-        recid = str(randomDigits(15))
-        
-        # activate yellow LED
-        GPIO.output(ylwLedPin,GPIO.HIGH)
-        
-        lcd.message('Let`s check who')
-        lcd.setCursor(0,1)
-        lcd.message('you are...')
-        time.sleep(1.5)
-        
-        for x in range(3, 0,-1):
-            lcd.clear()
-            lcd.message("Photo in %d" %x)
-            time.sleep(0.5)
-            
-        lcd.setCursor(0,1)
-        lcd.message('Cheese! :-)')
-        print("taking photo....")
-        uploadToS3(recid)
-        
-    else:
-        print("Button pushed")
-            
-def loop():
-    #Button detect
-    GPIO.add_event_detect(buttonPin,GPIO.FALLING,callback = buttonEvent,bouncetime=800)
-    while True:
-        time.sleep(0.05)
-        pass
+    # runs in the GPIO thread, the ring is handled by the event loop
+    smartDoor.post(BUTTON)
 
 def initHardware():
-        mcp.output(3,1)     # turn on LCD backlight
-        lcd.begin(16,2)     # set number of LCD lines and column
+        # only called at startup, the LCD is only written by the display worker
+        display.call(mcp.output,3,1)     # turn on LCD backlight
+        display.call(lcd.begin,16,2)     # set number of LCD lines and column
         GPIO.output(ylwLedPin,GPIO.LOW) # turn off all LEDs
         GPIO.output(redLedPin,GPIO.LOW) # turn off all LEDs
         GPIO.output(grnLedPin,GPIO.LOW) # turn off all LEDs
-        lcd.clear() # clear LCD
+        display.clear() # clear LCD
 #--------------------------------- Main function --------------------------------------------
 if __name__ == '__main__':
     setup()
@@ -403,16 +572,24 @@ if __name__ == '__main__':
         # Initialize LEDs and LCD display
         initHardware()
 
+        # Start continuous capture so that a frame is ready when the countdown ends (ring capture mode only)
+        cameraPipeline.start()
+
+        # Open the S3 connections now and keep them alive, so the first ring is as fast as the following ones
+        awsSession.prewarm()
+        awsSession.startKeepAlive()
+
         # Connect and subscribe to AWS Iot
         myAWSIoTMQTTClient.connect()
-        myAWSIoTMQTTClient.subscribe("rekognition/result", 1, photoVerificationCallback)
-        time.sleep(1)
-        myAWSIoTMQTTClient.subscribe("polly/result", 1, pollyCallback)
-        time.sleep(1)
-        
-        locked = 0
+        if result_mode == "combined":
+            myAWSIoTMQTTClient.subscribe("doorbell/result", 1, resultCallback)
+        else:
+            myAWSIoTMQTTClient.subscribe("rekognition/result", 1, photoVerificationCallback)
+            myAWSIoTMQTTClient.subscribe("polly/result", 1, pollyCallback)
         
-        loop()
+        #Button detect, the edges are handled as events in the event loop
+        GPIO.add_event_detect(buttonPin,GPIO.FALLING,callback = buttonEvent,bouncetime=800)
+        smartDoor.run()
         
     except KeyboardInterrupt:  # When 'Ctrl+C' is pressed, the child program destroy() will be  executed.
-        destroy()
\ No newline at end of file
+        destroy()
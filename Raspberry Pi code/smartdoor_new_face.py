@@ -5,23 +5,30 @@
         - Upload triggers Lambda Function "IndexFaces"
         - Lambda triggers Face Rekognition to create a new profile/match ID for the User
         - Lambda triggers DynamoDB and creates an entry with the User name (name parameter from commandline) and the Face Match ID from Rekognition
+    - Bulk mode: enrolls many users from a directory of images or a CSV/JSON manifest instead of the camera,
+      the images are uploaded concurrently and users that are already in DynamoDB are skipped
 # The code for this project is inspired and based on: https://softwaremill.com/access-control-system-with-rfid-and-amazon-rekognition/
   
 '''
 import sys
+import os
+import csv
 import logging
 import time
 import json
 import random
 import getopt
-import picamera
-import os
+import io
+import threading
 import boto3
-from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 # Usage
 usageInfo = """Usage:
 python smartdoor_new_face.py -n <name> -a <APIAccessKey> -s <APISecret> -b <Bucketname>
+python smartdoor_new_face.py -d <ImageDirectory> | -m <Manifest> -a <APIAccessKey> -s <APISecret> -b <Bucketname> [-t <DynamoDBTable>] [-g <AWSRegion>] [-w <Workers>]
 Type "python smartdoor_new_face.py -h" for available options.
 """
 # Help info
@@ -33,6 +40,16 @@ helpInfo = """-n, --name
         AWS User Access Secret
 -b, --bucket
         S3 Bucketname that was provisioned for FaceRecognition Service
+-d, --directory
+        Bulk mode: directory with one image per user (<name>.jpg) or one subdirectory per user (<name>/*.jpg)
+-m, --manifest
+        Bulk mode: CSV (name,image[,image...]) or JSON ([{"name": ..., "images": [...]}]) manifest, image paths relative to the manifest
+-t, --table
+        Bulk mode: DynamoDB table of the FaceRecognition Service, users that are already enrolled are skipped
+-g, --region
+        Bulk mode: AWS Region of the FaceRecognition Service, if not specified US-EAST-1 will be taken
+-w, --workers
+        Bulk mode: number of concurrent uploads (default 4)
 -h, --help
 	Help information
 """
@@ -42,9 +59,14 @@ name = ""
 access_key_id =""
 secret_access_key=""
 bucket_name=""
+directory=""
+manifest=""
+table_name=""
+region="us-east-1"
+workers=4
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], "hn:a:s:b:", ["help", "name=","accessKey=","secret=","bucket="])
+    opts, args = getopt.getopt(sys.argv[1:], "hn:a:s:b:d:m:t:g:w:", ["help", "name=","accessKey=","secret=","bucket=","directory=","manifest=","table=","region=","workers="])
     if len(opts) == 0:
         raise getopt.GetoptError("No input parameters!")
     for opt, arg in opts:
@@ -59,15 +81,33 @@ try:
             secret_access_key = arg
         if opt in ("-b", "--bucket"):
             bucket_name = arg
-except getopt.GetoptError:
+        if opt in ("-d", "--directory"):
+            directory = arg
+        if opt in ("-m", "--manifest"):
+            manifest = arg
+        if opt in ("-t", "--table"):
+            table_name = arg
+        if opt in ("-g", "--region"):
+            region = arg
+        if opt in ("-w", "--workers"):
+            workers = int(arg)
+except (getopt.GetoptError, ValueError):
     print(usageInfo)
     exit(1)
 
+bulkMode = bool(directory or manifest)
+
 # Missing configuration notification
 missingConfiguration = False
-if not name:
-	print("Missing '-n' or '--name'")
+if not name and not bulkMode:
+	print("Missing '-n' or '--name' (or '-d'/'-m' for the bulk mode)")
 	missingConfiguration = True
+if directory and manifest:
+    print("Use either '-d' or '-m'")
+    missingConfiguration = True
+if workers < 1:
+    print("Invalid '-w' or '--workers', use at least 1")
+    missingConfiguration = True
 if not access_key_id:
     print("Missing '-a' or '--accessKey'")
     missingConfiguration = True
@@ -85,45 +125,171 @@ if missingConfiguration:
 image_width = 800
 image_height = 600
 file_extension = '.jpg'
+image_types = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png'}
 
-# camera setup
-camera = picamera.PiCamera()
-camera.resolution = (image_width, image_height)
-camera.awb_mode = 'auto'
+# bulk mode: images that were uploaded are appended to this file (absolute path), a restarted run skips them
+progress_file = 'enroll_progress.txt'
+progress_lock = threading.Lock()
 
-def takePhoto(file_name):
+# one S3 client, shared by all upload threads
+s3 = boto3.client('s3', aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key, region_name=region,
+                  config=Config(max_pool_connections=max(workers, 10)))
+
+# camera setup (not needed in bulk mode, which can run on any machine)
+if not bulkMode:
+    import picamera
+    camera = picamera.PiCamera()
+    camera.resolution = (image_width, image_height)
+    camera.awb_mode = 'auto'
+
+def takePhoto(stream):
     ''' takes a picture of the user
-    file_name is the user name that was set with the name parameter on command line
+    the JPEG is written to the in-memory stream, nothing is stored on the SD card
     '''
-    filepath = file_name + file_extension
-    camera.capture(filepath)
+    camera.capture(stream, format='jpeg')
+    stream.seek(0)
     
-def uploadToS3(file_name):
+def uploadToS3(file_name, stream, content_type='image/jpeg'):
     ''' Uploads the User Picture to S3 Bucket
-    Upload triggers Lambda Function "Index Faces"
+    file_name is the object name below index/, <name>.jpg or <name>/<n>.jpg
+    Upload is streamed from the in-memory photo (or image file) and triggers Lambda Function "Index Faces"
     '''
     
-    filepath = file_name + file_extension
+    key = "index/" + file_name
     
-    # Metadata header "x-amz-meta-fullname" header is required for Lambda function to create an entry with te name in DynamoDB later
+    # Lambda function "Index Faces" takes the name for the DynamoDB entry from the key, no metadata is needed
     try:
-        client = boto3.client('s3',aws_access_key_id=access_key_id,aws_secret_access_key=secret_access_key)
-        response = client.upload_file(filepath, bucket_name, "index/" + filepath,ExtraArgs={'Metadata': {'cache-control': 'max-age=60','fullname': name}})
-    except ClientError as e:
+        s3.upload_fileobj(stream, bucket_name, key, ExtraArgs={'ContentType': content_type})
+    except (BotoCoreError, ClientError) as e:
         logging.error(e)
         return False
     return True
-
-    if os.path.exists(filepath):
-        os.remove(filepath)
         
+#--------------------------------- Bulk mode --------------------------------------------
+
+def readDirectory(path):
+    ''' Returns [(name, [image paths])] for <name>.jpg files and <name>/ subdirectories '''
+    entries = []
+    for entry in sorted(os.listdir(path)):
+        full = os.path.join(path, entry)
+        if os.path.isdir(full):
+            images = [os.path.join(full, f) for f in sorted(os.listdir(full)) if os.path.splitext(f)[1].lower() in image_types]
+            if images:
+                entries.append((entry, images))
+        elif os.path.splitext(entry)[1].lower() in image_types:
+            entries.append((os.path.splitext(entry)[0], [full]))
+    return entries
+
+def readManifest(path):
+    ''' Returns [(name, [image paths])] from a CSV or JSON manifest '''
+    base = os.path.dirname(os.path.abspath(path))
+    entries = []
+    if path.lower().endswith('.json'):
+        with open(path) as f:
+            for item in json.load(f):
+                images = item.get('images') or [item['image']]
+                entries.append((item['name'], images))
+    else:
+        with open(path, newline='') as f:
+            for row in csv.reader(f):
+                row = [cell.strip() for cell in row if cell.strip()]
+                if len(row) < 2 or (not entries and row[0].lower() == 'name'):
+                    continue
+                entries.append((row[0], row[1:]))
+    return [(person, [os.path.join(base, image) for image in images]) for person, images in entries]
+
+def enrolledNames():
+    ''' Returns the names that are already enrolled in the DynamoDB table '''
+    dynamodb = boto3.client('dynamodb', aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key, region_name=region)
+    names = set()
+    for page in dynamodb.get_paginator('scan').paginate(TableName=table_name, ProjectionExpression='FullName'):
+        for item in page['Items']:
+            names.add(item['FullName']['S'])
+    return names
+
+def uploadedImages():
+    ''' Returns the images that a previous run already uploaded '''
+    if not os.path.exists(progress_file):
+        return set()
+    with open(progress_file) as f:
+        return set(line.rstrip('\n') for line in f if line.strip())
+
+def enrollPerson(person, images, done, progress):
+    ''' Uploads the images of a person that are not done yet (index/<name>.jpg or index/<name>/<n>.jpg),
+    every uploaded image is written to the progress file, so a rerun does not index it a second time
+    PNG images are uploaded under a .jpg key as well, the S3 trigger of "Index Faces" only fires for .jpg keys
+    and Rekognition detects the image format from the content
+    Returns the uploaded bytes
+    '''
+    size = 0
+    for index, image in enumerate(images):
+        if os.path.abspath(image) in done:
+            continue
+        extension = os.path.splitext(image)[1].lower()
+        file_name = person + (file_extension if len(images) == 1 else "/%d%s" % (index + 1, file_extension))
+        with open(image, 'rb') as f:
+            if not uploadToS3(file_name, f, image_types.get(extension, 'image/jpeg')):
+                raise IOError("Upload of %s failed" % image)
+        with progress_lock:
+            progress.write(os.path.abspath(image) + '\n')
+            progress.flush()
+        size += os.path.getsize(image)
+    return size
+
+def bulkEnroll(entries):
+    ''' Uploads the images of all entries with a thread pool and prints the progress '''
+    done = uploadedImages()
+    enrolled = set()
+    if table_name:
+        try:
+            enrolled = enrolledNames()
+        except (BotoCoreError, ClientError) as e:
+            print("Enrolled users cannot be read from DynamoDB (%s), only the progress file is used" % e)
+    todo = []
+    for person, images in entries:
+        started = [image for image in images if os.path.abspath(image) in done]
+        # users enrolled outside of the progress file are skipped as a whole, the others image by image
+        if len(started) == len(images) or (person in enrolled and not started):
+            continue
+        todo.append((person, images))
+    print("%d users in the list, %d already enrolled, %d to upload with %d workers" % (len(entries), len(entries) - len(todo), len(todo), workers))
+
+    start = time.time()
+    uploaded, failed, totalBytes = 0, [], 0
+    with open(progress_file, 'a') as progress, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = dict((pool.submit(enrollPerson, person, images, done, progress), person) for person, images in todo)
+        for future in as_completed(futures):
+            person = futures[future]
+            try:
+                size = future.result()
+            except Exception as e:
+                failed.append(person)
+                print("[%d/%d] %s: failed (%s)" % (uploaded + len(failed), len(todo), person, e))
+                continue
+            uploaded += 1
+            totalBytes += size
+            print("[%d/%d] %s: uploaded" % (uploaded + len(failed), len(todo), person))
+
+    elapsed = time.time() - start
+    print("Uploaded %d users (%.1f MB) in %.1f s, %d skipped, %d failed" % (uploaded, totalBytes / 1e6, elapsed, len(entries) - len(todo), len(failed)))
+    if failed:
+        print("Failed: " + ", ".join(failed) + " - run the same command again to retry them")
+    return not failed
+
 #--------------------------------- Main Loop --------------------------------------------
 
 #--------------------------------- Main function --------------------------------------------
 if __name__ == '__main__':
+    if bulkMode:
+        entries = readDirectory(directory) if directory else readManifest(manifest)
+        if not bulkEnroll(entries):
+            exit(3)
+        print("Thats it. The users should be able to authenticate at the door once the images are indexed.")
+        exit(0)
     print("We must take a picture from " + name + " to create the authentication entry.")
     input("Please look into the camera and press ENTER when ready.")
-    takePhoto(name)
-    uploadToS3(name)
+    photo = io.BytesIO()
+    takePhoto(photo)
+    uploadToS3(name + file_extension, photo)
     print("Thats it. You should now be able to authenticate at the door.")
 	